@@ -0,0 +1,97 @@
+"""
+Сколько event loop простаивает, пока бот читает PDF.
+
+    python bench/doc_stall.py --pages 300
+    python bench/doc_stall.py --pdf contract.pdf
+
+Рядом с извлечением текста крутится «тикер», который спит по 10 мс
+и замеряет, насколько позже просыпается. Сравниваются два режима:
+read_document_text прямо в loop (как было) и extract_document_text через пул процессов.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("TELEGRAM_TOKEN", "bench")
+os.environ.setdefault("MISTRAL_API_KEY", "bench")
+
+import bot  # noqa: E402
+
+TICK = 0.01
+
+
+def make_pdf(pages: int) -> bytes:
+    """Минимальный PDF с текстом на каждой странице — без сторонних библиотек"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    line = b"Contract clause %d: the parties agree to the terms and conditions set forth herein. "
+    for i in range(pages):
+        body = b"BT /F1 10 Tf 40 800 Td 12 TL " + b" ".join(b"(" + (line % (i * 60 + j)) + b") '" for j in range(60)) + b" ET"
+        objects.append(b"<< /Length %d >>\nstream\n" % len(body) + body + b"\nendstream")
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % k for k in kids) + b"] /Count %d >>" % pages
+
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for n, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % n + obj + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+async def measure(extract) -> dict:
+    lags, done = [], asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lags.append(time.perf_counter() - started - TICK)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(TICK * 2)
+    started = time.perf_counter()
+    text = await extract()
+    elapsed = time.perf_counter() - started
+    done.set()
+    await task
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "chars": len(text),
+        "max_stall_ms": round(max(lags) * 1000, 1),
+        "p99_stall_ms": round(bot.percentile(lags, 99) * 1000, 1),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdf")
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=10 ** 9, help="бюджет символов; по умолчанию — весь файл")
+    args = parser.parse_args()
+
+    data = open(args.pdf, "rb").read() if args.pdf else make_pdf(args.pages)
+    bot.DOC_CHAR_LIMIT = args.limit
+
+    async def inline():
+        return bot.read_document_text(data, "bench.pdf", args.limit)
+
+    async def pooled():
+        return await bot.extract_document_text(data, "bench.pdf")
+
+    bot.get_doc_pool().submit(int).result()  # поднимаем воркеры заранее, чтобы не мерить их старт
+    print("inline:", await measure(inline))
+    print("pool:  ", await measure(pooled))
+    bot.reset_doc_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
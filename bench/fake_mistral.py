@@ -0,0 +1,65 @@
+"""
+Локальный фейковый Mistral для проверки бота без сети.
+
+    python bench/fake_mistral.py --port 8081 --latency 0.3
+    MISTRAL_URL=http://127.0.0.1:8081/v1/chat/completions python bot.py
+
+Поддерживает обычный ответ и SSE-стрим (stream: true).
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+ANSWER = (
+    "По ст. 158 УК РФ кража наказывается штрафом до 80 тысяч рублей. "
+    "Если ущерб до 2500 рублей — это мелкое хищение по ст. 7.27 КоАП РФ. "
+    "Я не замена юристу, но направление подскажу."
+)
+
+
+def make_app(latency: float = 0.2, token_delay: float = 0.03, error_rate: float = 0.0) -> web.Application:
+    async def completions(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        await asyncio.sleep(latency)
+        if error_rate and random.random() < error_rate:
+            return web.json_response({"message": "rate limited"}, status=429, headers={"Retry-After": "1"})
+
+        created = int(time.time())
+        usage = {"prompt_tokens": 100, "completion_tokens": len(ANSWER.split()), "total_tokens": 100 + len(ANSWER.split())}
+
+        if not body.get("stream"):
+            return web.json_response({
+                "id": "fake", "object": "chat.completion", "created": created,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": ANSWER}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for word in ANSWER.split(" "):
+            chunk = {"id": "fake", "created": created, "choices": [{"index": 0, "delta": {"content": word + " "}}]}
+            await resp.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            await asyncio.sleep(token_delay)
+        last = {"id": "fake", "created": created, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+        await resp.write(f"data: {json.dumps(last)}\n\n".encode())
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-delay", type=float, default=0.03)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(make_app(args.latency, args.token_delay, args.error_rate), port=args.port)
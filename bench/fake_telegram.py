@@ -0,0 +1,90 @@
+"""
+Локальный фейковый Telegram Bot API для нагрузочных тестов без сети.
+
+    python bench/fake_telegram.py --port 8082 --latency 0.05
+    TELEGRAM_API_URL=http://127.0.0.1:8082 python bot.py
+
+Отвечает на методы, которые зовёт бот (sendMessage, editMessageText, getFile, ...),
+отдаёт файл для getFile и считает вызовы по методам: GET /stats.
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Сократ", "username": "sokrat_bench_bot"}
+MESSAGE_METHODS = {"sendMessage", "editMessageText", "editMessageReplyMarkup", "sendPhoto", "sendDocument"}
+
+
+def make_app(latency: float = 0.03, error_rate: float = 0.0, file_data: bytes = b"") -> web.Application:
+    calls: Counter = Counter()
+    state = {"message_id": 0, "started": time.time()}
+
+    async def method(request: web.Request) -> web.Response:
+        name = request.match_info["method"]
+        params = dict(await request.post())
+        calls[name] += 1
+        await asyncio.sleep(latency)
+        if error_rate and name in MESSAGE_METHODS and random.random() < error_rate:
+            calls["429"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            })
+
+        if name == "getMe":
+            result = BOT_USER
+        elif name in MESSAGE_METHODS:
+            state["message_id"] += 1
+            chat_id = int(params.get("chat_id") or 0)
+            result = {
+                "message_id": int(params.get("message_id") or state["message_id"]),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        elif name == "getFile":
+            file_id = params.get("file_id", "file")
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(file_data),
+                      "file_path": f"documents/{file_id}.pdf"}
+        else:
+            result = True  # sendChatAction, answerCallbackQuery, deleteWebhook, setWebhook, ...
+        return web.json_response({"ok": True, "result": result})
+
+    async def file(request: web.Request) -> web.Response:
+        calls["download"] += 1
+        await asyncio.sleep(latency)
+        return web.Response(body=file_data, content_type="application/pdf")
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response({"calls": dict(calls), "uptime": time.time() - state["started"]})
+
+    async def reset(request: web.Request) -> web.Response:
+        calls.clear()
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", method)
+    app.router.add_get("/file/bot{token}/{path:.+}", file)
+    app.router.add_get("/stats", stats)
+    app.router.add_post("/stats/reset", reset)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.03)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--file", help="что отдавать на скачивание документа (по умолчанию пусто)")
+    args = parser.parse_args()
+    data = b""
+    if args.file:
+        with open(args.file, "rb") as f:
+            data = f.read()
+    web.run_app(make_app(args.latency, args.error_rate, data), port=args.port, print=None)
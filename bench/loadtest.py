@@ -0,0 +1,490 @@
+"""
+Нагрузочный прогон бота целиком на локальных фейках — без Telegram и Mistral.
+
+    pip install -r bench/requirements.txt
+    python bench/loadtest.py --users 2000 --duration 60
+    python bench/loadtest.py --users 2000 --database-url postgresql://postgres@localhost/bench
+    python bench/loadtest.py --users 500 --compare bench/results/abc1234.json
+
+Поднимает bench/fake_telegram.py и bench/fake_mistral.py отдельными процессами,
+строит приложение через bot.build_application() и гонит апдейты синтетических
+пользователей через тот же update_processor, что и polling: вопросы (reply),
+оценки (button_handler), PDF (handle_document) и одна рассылка от админа (broadcast_cmd).
+
+Итог — p50/p95/p99 по каждому типу апдейта, сообщений в секунду, запросов к БД
+на сообщение, рост памяти и лаг event loop. Всё пишется в JSON (--out), чтобы
+сравнивать прогоны между коммитами (--compare).
+"""
+import argparse
+import asyncio
+import contextvars
+import datetime
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+sys.path.insert(0, ROOT)
+
+ADMIN_ID = 999_999_999
+
+# Часть вопросов повторяется (кэш ответов), часть — прямые ссылки на статьи (индекс кодексов)
+QUESTIONS = [
+    "Что будет за кражу телефона?",
+    "Можно ли уволить без предупреждения?",
+    "Как вернуть товар без чека?",
+    "Сколько платят алименты на одного ребёнка?",
+    "Что делать, если не выплачивают зарплату?",
+    "Могут ли оштрафовать за переход на красный?",
+    "ст. 158 УК РФ",
+    "статья 81 ТК РФ",
+]
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def summarize(values: list[float]) -> dict:
+    from bot import percentile
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50) * 1000, 1),
+        "p95": round(percentile(values, 95) * 1000, 1),
+        "p99": round(percentile(values, 99) * 1000, 1),
+        "max": round(max(values, default=0) * 1000, 1),
+    }
+
+
+# ──────────────────────────────────────────
+# СЧЁТЧИК ЗАПРОСОВ К БД
+# ──────────────────────────────────────────
+DB_METHODS = {"execute", "executemany", "fetch", "fetchrow", "fetchval", "copy_records_to_table"}
+
+
+class CountingConnection:
+    """Прокси соединения asyncpg: каждый вызов запроса — один round-trip"""
+
+    def __init__(self, conn, counts: Counter):
+        self._conn = conn
+        self._counts = counts
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if name not in DB_METHODS:
+            return attr
+
+        async def counted(*args, **kwargs):
+            self._counts[name] += 1
+            return await attr(*args, **kwargs)
+        return counted
+
+    def transaction(self, *args, **kwargs):
+        self._counts["transaction"] += 2  # BEGIN + COMMIT/ROLLBACK
+        return self._conn.transaction(*args, **kwargs)
+
+
+class CountingAcquire:
+    def __init__(self, ctx, counts: Counter):
+        self._ctx = ctx
+        self._counts = counts
+
+    async def __aenter__(self):
+        return CountingConnection(await self._ctx.__aenter__(), self._counts)
+
+    async def __aexit__(self, *exc):
+        return await self._ctx.__aexit__(*exc)
+
+
+class CountingPool:
+    def __init__(self, pool):
+        self._pool = pool
+        self.counts: Counter = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self._pool, name)
+        if name not in DB_METHODS:
+            return attr
+
+        async def counted(*args, **kwargs):
+            self.counts[name] += 1
+            return await attr(*args, **kwargs)
+        return counted
+
+    def acquire(self, *args, **kwargs):
+        return CountingAcquire(self._pool.acquire(*args, **kwargs), self.counts)
+
+
+# ──────────────────────────────────────────
+# СИНТЕТИЧЕСКИЕ АПДЕЙТЫ
+# ──────────────────────────────────────────
+class Population:
+    def __init__(self, pdf_size: int):
+        self.update_id = 0
+        self.message_id = 0
+        self.pdf_size = pdf_size
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id: int, **fields) -> dict:
+        self.update_id += 1
+        self.message_id += 1
+        return {
+            "update_id": self.update_id,
+            "message": {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id),
+                **fields,
+            },
+        }
+
+    def text(self, user_id: int) -> dict:
+        if random.random() < 0.6:
+            question = random.choice(QUESTIONS)
+        else:
+            question = f"Сосед #{random.randrange(10**6)} залил квартиру, что делать?"
+        return self._message(user_id, text=question)
+
+    def command(self, user_id: int, text: str) -> dict:
+        name = text.split()[0]
+        return self._message(user_id, text=text, entities=[{"type": "bot_command", "offset": 0, "length": len(name)}])
+
+    def document(self, user_id: int) -> dict:
+        file_id = f"doc{self.message_id}"
+        return self._message(user_id, document={
+            "file_id": file_id, "file_unique_id": file_id, "file_name": "contract.pdf",
+            "mime_type": "application/pdf", "file_size": self.pdf_size,
+        })
+
+    def rating(self, user_id: int, question_id: int) -> dict:
+        self.update_id += 1
+        return {
+            "update_id": self.update_id,
+            "callback_query": {
+                "id": str(self.update_id),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": f"rate_{random.choice((5, 5, 1))}_{question_id}",
+                "message": {
+                    "message_id": self.message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": 1, "is_bot": True, "first_name": "Сократ"},
+                    "text": "ответ",
+                },
+            },
+        }
+
+
+# ──────────────────────────────────────────
+# ПРОГОН
+# ──────────────────────────────────────────
+async def start_fake(script: str, *args: str) -> asyncio.subprocess.Process:
+    return await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(HERE, script), *args,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+
+
+async def wait_port(url: str, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{url} не поднялся за {timeout} с")
+                await asyncio.sleep(0.1)
+
+
+async def run(args) -> dict:
+    from telegram import Update
+    import bot
+
+    application = bot.build_application()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()  # иначе PTB не дожидается задач неблокирующих хендлеров
+    db_counts = None
+    if bot.db_pool:
+        bot.db_pool = CountingPool(bot.db_pool)
+        db_counts = bot.db_pool.counts
+
+    # id вопроса для кнопки оценки: бот его не хранит, он есть только в callback_data ответа
+    asked: dict[int, int] = {}
+    save_question = bot.save_question
+
+    async def remember_question(user_id: int, *rest, **kwargs) -> int:
+        asked[user_id] = await save_question(user_id, *rest, **kwargs)
+        return asked[user_id]
+    bot.save_question = remember_question
+
+    # Ответы и документы идут вне слотов PTB (block=False) — process_update возвращается сразу.
+    # Задача хендлера наследует контекст feed() и отмечается здесь, чтобы её можно было дождаться.
+    handler_tasks: contextvars.ContextVar[list] = contextvars.ContextVar("handler_tasks")
+
+    def tracked(callback):
+        async def run_tracked(update, context):
+            tasks = handler_tasks.get(None)
+            if tasks is not None:
+                tasks.append(asyncio.current_task())
+            return await callback(update, context)
+        return run_tracked
+
+    for group in application.handlers.values():
+        for handler in group:
+            if not handler.block:
+                handler.callback = tracked(handler.callback)
+
+    population = Population(args.pdf_size)
+    latencies: dict[str, list[float]] = defaultdict(list)
+    loop_lag: list[float] = []
+    memory: list[float] = [rss_mb()]
+    broadcast: dict = {}
+    running = True
+
+    async def feed(kind: str, data: dict):
+        update = Update.de_json(data, application.bot)
+        started = time.perf_counter()
+        tasks: list = []
+        handler_tasks.set(tasks)
+        await application.update_processor.process_update(update, application.process_update(update))
+        await asyncio.sleep(0)  # даём неблокирующей задаче стартовать и отметиться
+        await asyncio.gather(*tasks, return_exceptions=True)
+        latencies[kind].append(time.perf_counter() - started)
+
+    async def user_loop(user_id: int, deadline: float):
+        await asyncio.sleep(random.uniform(0, args.ramp))
+        while time.monotonic() < deadline:
+            if random.random() < args.doc_share:
+                await feed("document", population.document(user_id))
+            else:
+                await feed("reply", population.text(user_id))
+                question_id = asked.get(user_id)
+                if question_id and random.random() < args.rate_share:
+                    await asyncio.sleep(random.uniform(0.5, 2))
+                    await feed("button", population.rating(user_id, question_id))
+            # не чаще RATE_LIMIT_SECONDS, как живой человек
+            await asyncio.sleep(args.think + random.uniform(0, args.think))
+
+    async def admin_broadcast():
+        await asyncio.sleep(args.broadcast_at)
+        started = time.perf_counter()
+        await feed("broadcast", population.command(ADMIN_ID, "/broadcast Нагрузочная рассылка"))
+        while bot.broadcast_tasks:
+            await asyncio.sleep(0.1)
+        broadcast["seconds"] = round(time.perf_counter() - started, 2)
+
+    async def sampler():
+        while running:
+            before = time.perf_counter()
+            await asyncio.sleep(0.01)
+            loop_lag.append(time.perf_counter() - before - 0.01)
+            if len(loop_lag) % 50 == 0:
+                memory.append(rss_mb())
+
+    sampler_task = asyncio.create_task(sampler())
+    started = time.perf_counter()
+    deadline = time.monotonic() + args.duration
+    tasks = [asyncio.create_task(user_loop(1000 + i, deadline)) for i in range(args.users)]
+    if args.broadcast_at and bot.db_pool:
+        tasks.append(asyncio.create_task(admin_broadcast()))
+    await asyncio.gather(*tasks)
+    await bot.flush_writes()
+    elapsed = time.perf_counter() - started
+    running = False
+    await sampler_task
+    memory.append(rss_mb())
+
+    async with httpx.AsyncClient() as client:
+        telegram_calls = (await client.get(f"http://127.0.0.1:{args.telegram_port}/stats")).json()["calls"]
+    db_total = dict(db_counts or {})
+    if broadcast:
+        row = await bot._fetchrow("SELECT sent, failed, blocked FROM broadcasts ORDER BY id DESC LIMIT 1")
+        broadcast.update(row)
+        broadcast["per_s"] = round(row["sent"] / max(broadcast["seconds"], 0.01), 1)
+
+    await application.stop()
+    await application.post_shutdown(application)
+    await application.shutdown()
+    if bot.db_pool:
+        await bot.db_pool.close()
+
+    messages = sum(len(v) for v in latencies.values())
+    return {
+        "commit": git_commit(),
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "config": vars(args),
+        "duration_s": round(elapsed, 2),
+        "messages": messages,
+        "messages_per_s": round(messages / elapsed, 1),
+        "latency_ms": {kind: summarize(values) for kind, values in sorted(latencies.items())},
+        "db": None if db_counts is None else {
+            "round_trips": sum(db_total.values()),
+            "per_message": round(sum(db_total.values()) / max(messages, 1), 3),
+            "by_method": db_total,
+        },
+        "memory_mb": {
+            "start": round(memory[0], 1),
+            "end": round(memory[-1], 1),
+            "peak": round(max(memory), 1),
+            "growth": round(memory[-1] - memory[0], 1),
+        },
+        "stage_mean_ms": {
+            "/".join(v for _, v in key): round(row[-2] / row[-1] * 1000, 1)
+            for key, row in sorted(bot.STAGE_SECONDS.series.items()) if row[-1]
+        },
+        "loop_lag_ms": summarize(loop_lag),
+        "telegram_calls": telegram_calls,
+        "llm": {**bot.llm_stats, "errors_by_type": dict(bot.llm_errors)},
+        "answers": {"/".join(v for _, v in k): n for k, n in bot.ANSWERS.values.items()},
+        "errors": {"/".join(v for _, v in k): n for k, n in bot.ERRORS.values.items()},
+        "rate_limited": sum(bot.RATE_LIMITED.values.values()),
+        "broadcast": broadcast or None,
+    }
+
+
+# ──────────────────────────────────────────
+# ОТЧЁТ
+# ──────────────────────────────────────────
+def print_report(result: dict):
+    print(f"\nкоммит {result['commit']}: {result['messages']} апдейтов за {result['duration_s']} с "
+          f"→ {result['messages_per_s']}/с")
+    print(f"{'тип':<10} {'n':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  (мс)")
+    for kind, s in result["latency_ms"].items():
+        print(f"{kind:<10} {s['count']:>7} {s['p50']:>8} {s['p95']:>8} {s['p99']:>8} {s['max']:>8}")
+    print("по этапам, среднее: " + ", ".join(f"{k} {v}" for k, v in result["stage_mean_ms"].items()))
+    lag = result["loop_lag_ms"]
+    print(f"лаг loop: p50 {lag['p50']} / p99 {lag['p99']} / max {lag['max']} мс")
+    if result["db"]:
+        print(f"БД: {result['db']['round_trips']} запросов, {result['db']['per_message']} на апдейт")
+    mem = result["memory_mb"]
+    print(f"память: {mem['start']} → {mem['end']} МБ (пик {mem['peak']}, рост {mem['growth']:+})")
+    if result["broadcast"]:
+        b = result["broadcast"]
+        print(f"рассылка: {b['sent']} сообщений за {b['seconds']} с ({b['per_s']}/с)")
+    if result["errors"]:
+        print(f"ошибки: {result['errors']}")
+
+
+def compare(old: dict, new: dict):
+    def row(name, a, b, lower_is_better=True):
+        if not a:
+            return
+        change = (b - a) / a * 100
+        worse = change > 10 if lower_is_better else change < -10
+        print(f"{name:<24} {a:>10} → {b:<10} {change:+6.1f}%{'  ⚠️' if worse else ''}")
+
+    print(f"\nсравнение с {old['commit']} ({old['started_at']}):")
+    row("апдейтов/с", old["messages_per_s"], new["messages_per_s"], lower_is_better=False)
+    for kind, s in new["latency_ms"].items():
+        before = old["latency_ms"].get(kind)
+        if before:
+            for p in ("p50", "p95", "p99"):
+                row(f"{kind} {p}, мс", before[p], s[p])
+    if old.get("db") and new.get("db"):
+        row("БД на апдейт", old["db"]["per_message"], new["db"]["per_message"])
+    row("рост памяти, МБ", old["memory_mb"]["growth"], new["memory_mb"]["growth"])
+
+
+async def main(args):
+    pdf = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+    with pdf:
+        from doc_stall import make_pdf
+        pdf.write(make_pdf(args.pdf_pages))
+    args.pdf_size = os.path.getsize(pdf.name)
+
+    fakes = [
+        await start_fake("fake_telegram.py", "--port", str(args.telegram_port),
+                         "--latency", str(args.telegram_latency), "--error-rate", str(args.telegram_error_rate),
+                         "--file", pdf.name),
+        await start_fake("fake_mistral.py", "--port", str(args.mistral_port),
+                         "--latency", str(args.mistral_latency), "--token-delay", str(args.mistral_token_delay),
+                         "--error-rate", str(args.mistral_error_rate)),
+    ]
+    try:
+        await wait_port(f"http://127.0.0.1:{args.telegram_port}/stats")
+        await wait_port(f"http://127.0.0.1:{args.mistral_port}/")
+        return await run(args)
+    finally:
+        for proc in fakes:
+            proc.terminate()
+            await proc.wait()
+        os.unlink(pdf.name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=30, help="сек")
+    parser.add_argument("--ramp", type=float, default=5, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument("--think", type=float, default=3.5, help="пауза между вопросами, не меньше rate limit")
+    parser.add_argument("--doc-share", type=float, default=0.02)
+    parser.add_argument("--rate-share", type=float, default=0.3)
+    parser.add_argument("--pdf-pages", type=int, default=5)
+    parser.add_argument("--broadcast-at", type=float, default=10, help="сек от старта; 0 — без рассылки")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"), help="без неё — прогон без БД")
+    parser.add_argument("--telegram-port", type=int, default=8082)
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0)
+    parser.add_argument("--mistral-port", type=int, default=8081)
+    parser.add_argument("--mistral-latency", type=float, default=0.3)
+    parser.add_argument("--mistral-token-delay", type=float, default=0.01)
+    parser.add_argument("--mistral-error-rate", type=float, default=0.0)
+    parser.add_argument("--out", help="куда писать JSON (по умолчанию bench/results/<коммит>.json)")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    # Конфиг bot.py читается при импорте — окружение задаём до него
+    os.environ.update({
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.telegram_port}",
+        "MISTRAL_URL": f"http://127.0.0.1:{args.mistral_port}/v1/chat/completions",
+        "ADMIN_ID": str(ADMIN_ID),
+        "METRICS_PORT": "0",
+        "BOT_MODE": "polling",
+    })
+    os.environ.setdefault("TELEGRAM_TOKEN", "123:bench")
+    os.environ.setdefault("MISTRAL_API_KEY", "bench")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("DB_SSL", "disable")
+    os.environ.pop("DATABASE_URL", None)
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+
+    result = asyncio.run(main(args))
+    print_report(result)
+
+    out = args.out or os.path.join(HERE, "results", f"{result['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 {out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), result)
@@ -0,0 +1,24 @@
+"""
+Отправляет записанные апдейты Telegram в webhook бота.
+
+    BOT_MODE=webhook WEBHOOK_SECRET=s3cret python bot.py
+    python bench/post_updates.py --secret s3cret bench/updates/*.json
+"""
+import argparse
+import json
+
+import httpx
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/telegram")
+    parser.add_argument("--secret", required=True)
+    args = parser.parse_args()
+
+    with httpx.Client() as client:
+        for path in args.files:
+            with open(path, encoding="utf-8") as f:
+                update = json.load(f)
+            response = client.post(args.url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": args.secret})
+            print(f"{path}: {response.status_code}")
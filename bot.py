@@ -1,22 +1,178 @@
-import httpx
+import importlib
 import os
 import time
+
+# STARTUP_PROFILE=1: тяжёлые зависимости грузятся по одной, и в логе старта видна цена каждой
+BOOT_STARTED = time.perf_counter()
+startup_timings: list[tuple[str, float]] = []  # (шаг, сек)
+if os.getenv("STARTUP_PROFILE") == "1":
+    for _module in ("httpx", "asyncpg", "telegram", "telegram.ext"):
+        _started = time.perf_counter()
+        importlib.import_module(_module)
+        startup_timings.append((f"import {_module}", time.perf_counter() - _started))
+
+import contextlib
+import contextvars
+import hashlib
+import heapq
+import hmac
+import httpx
+import io
+import json
+import logging
+import math
+import random
+import re
+import signal
+import sys
 import asyncio
 import asyncpg
-from collections import defaultdict
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler,
-    CallbackQueryHandler, filters, ContextTypes
+    ApplicationBuilder, ApplicationHandlerStop, CommandHandler, MessageHandler,
+    CallbackQueryHandler, SimpleUpdateProcessor, TypeHandler, filters, ContextTypes
 )
 
+IMPORTS_DONE = time.perf_counter()
+startup_timings.append(("imports", IMPORTS_DONE - BOOT_STARTED))
+
 # ──────────────────────────────────────────
 # КОНФИГ
 # ──────────────────────────────────────────
 TELEGRAM_TOKEN  = os.getenv("TELEGRAM_TOKEN")
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
 DATABASE_URL    = os.getenv("DATABASE_URL")
+DB_SSL          = os.getenv("DB_SSL", "require")  # disable — для локального Postgres без TLS
 ADMIN_ID        = int(os.getenv("ADMIN_ID", "0"))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")  # подмена для локальных тестов
+
+# HTTP-клиент к Mistral (один на весь процесс)
+HTTP_MAX_CONNECTIONS  = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE    = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT  = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT     = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+HTTP_PREWARM          = os.getenv("HTTP_PREWARM", "1") == "1"  # TLS-рукопожатие с Mistral ещё на старте
+
+# Стриминг ответов: ответ печатается по мере генерации
+MISTRAL_URL          = os.getenv("MISTRAL_URL", "https://api.mistral.ai/v1/chat/completions")
+STREAM_REPLIES       = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # Telegram режет частые правки
+
+# Кэш ответов на первые вопросы (без истории)
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL  = float(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600)))
+ANSWER_CACHE_WARM = int(os.getenv("ANSWER_CACHE_WARM", "200"))  # сколько ответов с 👍 грузить из БД
+
+# Пакетная запись в БД
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "0.2"))  # сек
+WRITE_FLUSH_ROWS     = int(os.getenv("WRITE_FLUSH_ROWS", "500"))
+QUESTION_ID_BLOCK    = int(os.getenv("QUESTION_ID_BLOCK", "100"))
+KNOWN_USERS_MAX      = int(os.getenv("KNOWN_USERS_MAX", "100000"))  # LRU уже записанных пользователей
+WRITE_QUEUE_MAX      = int(os.getenv("WRITE_QUEUE_MAX", "200000"))  # строк, пока БД недоступна
+
+# Пул asyncpg
+DB_POOL_MIN        = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX        = int(os.getenv("DB_POOL_MAX", "10"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "100"))  # 0 — за pgbouncer в режиме transaction
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "5"))
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+DB_IDLE_LIFETIME   = float(os.getenv("DB_IDLE_LIFETIME", "300"))  # простаивающие соединения закрываются
+DB_HEALTH_INTERVAL = float(os.getenv("DB_HEALTH_INTERVAL", "5"))
+
+# Рассылка: Telegram пускает ~30 сообщений/сек на бота и ~1/сек в один чат
+BROADCAST_RATE              = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY       = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_PAGE_SIZE         = int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+BROADCAST_RETRIES           = 3
+
+# Документы: PDF разбирается в отдельных процессах, чтобы не блокировать event loop
+DOC_CHAR_LIMIT       = int(os.getenv("DOC_CHAR_LIMIT", "150000"))  # дальше документ не читаем
+DOC_MAX_BYTES        = int(os.getenv("DOC_MAX_BYTES", str(20 * 1024 * 1024)))  # лимит Bot API на скачивание
+DOC_WORKERS          = int(os.getenv("DOC_WORKERS", "2"))
+DOC_EXTRACT_TIMEOUT  = float(os.getenv("DOC_EXTRACT_TIMEOUT", "20"))
+DOC_WORKER_MEMORY_MB = int(os.getenv("DOC_WORKER_MEMORY_MB", "1024"))
+DOC_PREWARM          = os.getenv("DOC_PREWARM", "1") == "1"  # поднять воркеры с pypdf в фоне после старта
+
+# Длинные документы: куски разбираются параллельно (map), заметки сводятся в один отчёт (reduce)
+DOC_CHUNK_CHARS     = int(os.getenv("DOC_CHUNK_CHARS", "5000"))  # ~1700 токенов: с шаблоном и системным промптом влезает в CONTEXT_TOKEN_BUDGET
+DOC_CHUNK_OVERLAP   = int(os.getenv("DOC_CHUNK_OVERLAP", "300"))
+DOC_MAP_CONCURRENCY = int(os.getenv("DOC_MAP_CONCURRENCY", "4"))  # запросов к Mistral на один документ
+DOC_CACHE_SIZE      = int(os.getenv("DOC_CACHE_SIZE", "200"))
+DOC_CACHE_TTL       = float(os.getenv("DOC_CACHE_TTL", str(7 * 24 * 3600)))
+
+# История диалогов: memory | postgres | sqlite
+HISTORY_BACKEND     = os.getenv("HISTORY_BACKEND", "memory")
+HISTORY_SQLITE_PATH = os.getenv("HISTORY_SQLITE_PATH", "history.sqlite3")
+HISTORY_MAX_USERS   = int(os.getenv("HISTORY_MAX_USERS", "50000"))
+HISTORY_IDLE_TTL    = float(os.getenv("HISTORY_IDLE_TTL", str(6 * 3600)))
+HISTORY_MAX_BYTES   = int(os.getenv("HISTORY_MAX_MB", "64")) * 1024 * 1024
+
+# Локальный индекс кодексов
+CODEX_DIR           = os.getenv("CODEX_DIR", "codex")
+CODEX_INDEX_DIR     = os.getenv("CODEX_INDEX_DIR", os.path.join(CODEX_DIR, ".index"))
+CODEX_TOP_K         = int(os.getenv("CODEX_TOP_K", "3"))
+CODEX_SNIPPET_CHARS = int(os.getenv("CODEX_SNIPPET_CHARS", "600"))
+
+# Бюджет входных токенов: старые сообщения истории отбрасываются первыми
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+CHARS_PER_TOKEN      = float(os.getenv("CHARS_PER_TOKEN", "3.0"))  # для русского текста у Mistral
+
+# Планировщик запросов к Mistral
+LLM_MAX_IN_FLIGHT     = int(os.getenv("LLM_MAX_IN_FLIGHT", "8"))
+LLM_QUEUE_MAX         = int(os.getenv("LLM_QUEUE_MAX", "200"))  # ждущих слота; сверх — сразу «занято»
+LLM_MAX_RETRIES       = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE      = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX       = float(os.getenv("LLM_BACKOFF_MAX", "10"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))    # ошибок подряд
+LLM_BREAKER_COOLDOWN  = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))  # сек
+
+# Сколько апдейтов PTB обрабатывает параллельно (по умолчанию он идёт строго по одному)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+
+# Режим работы: polling | webhook
+BOT_MODE                = os.getenv("BOT_MODE", "polling")
+DROP_PENDING_UPDATES    = os.getenv("DROP_PENDING_UPDATES", "1") == "1"
+WEBHOOK_URL             = os.getenv("WEBHOOK_URL")  # публичный адрес; если не задан, setWebhook не делаем
+WEBHOOK_PATH            = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_PORT            = int(os.getenv("PORT", "8080"))
+WEBHOOK_SECRET          = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+UPDATE_QUEUE_SIZE       = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))  # ждущих апдейтов сверх CONCURRENT_UPDATES
+
+# Несколько реплик: апдейты делятся по chat_id, чужие пересылаются владельцу.
+# REPLICA_URLS — внутренние адреса webhook всех реплик по порядку (http://bot-0:8080/telegram,...).
+# Polling умеет только одна реплика (REPLICA_ID=0), остальные — BOT_MODE=webhook без WEBHOOK_URL.
+REPLICA_ID              = int(os.getenv("REPLICA_ID", "0"))
+REPLICA_URLS            = [u.strip() for u in os.getenv("REPLICA_URLS", "").split(",") if u.strip()]
+REPLICA_COUNT           = max(1, len(REPLICA_URLS))
+REPLICA_FORWARD_TIMEOUT = float(os.getenv("REPLICA_FORWARD_TIMEOUT", "5"))
+STATE_BACKEND           = os.getenv("STATE_BACKEND", "memory")  # memory | postgres — где живёт rate limit
+STATE_SWEEP_INTERVAL    = float(os.getenv("STATE_SWEEP_INTERVAL", "300"))
+
+# Наблюдаемость
+LOG_FORMAT   = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_LEVEL    = os.getenv("LOG_LEVEL", "INFO")
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))  # 0 — не поднимать /metrics
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE") == "1"  # время каждого импорта и шага старта в лог
+
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    raise ValueError("Для webhook нужен WEBHOOK_SECRET")
+
+if REPLICA_COUNT > 1:
+    if not WEBHOOK_SECRET:
+        raise ValueError("Реплики пересылают апдейты через webhook — нужен WEBHOOK_SECRET")
+    if not 0 <= REPLICA_ID < REPLICA_COUNT:
+        raise ValueError(f"REPLICA_ID должен быть от 0 до {REPLICA_COUNT - 1}")
+    if BOT_MODE == "polling" and REPLICA_ID != 0:
+        raise ValueError("Polling только на реплике 0, остальным — BOT_MODE=webhook")
 
 if not TELEGRAM_TOKEN or not MISTRAL_API_KEY:
     raise ValueError("Нет токенов! Проверь Railway Variables")
@@ -33,165 +189,2238 @@ SYSTEM_PROMPT = """Ты — Сократ, древнегреческий фил
 - Старайся отвечать разнаобразно 
 ВАЖНО: ТОЛЬКО РУССКИЙ ЯЗЫК."""
 
+# ──────────────────────────────────────────
+# ЛОГИ И МЕТРИКИ
+# ──────────────────────────────────────────
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись; поля из extra={"fields": {...}} кладутся на верхний уровень"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "msg": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+log = logging.getLogger("sokrat")
+
+
+def setup_logging():
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logging.basicConfig(level=LOG_LEVEL, handlers=[handler], force=True)
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # не пишем строку на каждый запрос
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _labels_text(key: tuple, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in key] + ([extra] if extra else [])
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metric:
+    """Минимальная реализация формата Prometheus — без prometheus_client"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        metrics_registry.append(self)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+
+class MetricCounter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self.values: dict[tuple, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[_labels_key(labels)] += amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_labels_text(k)} {v}" for k, v in self.values.items()]
+
+
+class MetricHistogram(Metric):
+    kind = "histogram"
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self.series: dict[tuple, list] = {}  # ключ меток -> [счётчики бакетов..., сумма, количество]
+
+    def observe(self, value: float, **labels):
+        row = self.series.setdefault(_labels_key(labels), [0] * len(self.BUCKETS) + [0.0, 0])
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, row in self.series.items():
+            for bound, count in zip(self.BUCKETS, row):
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels_text(key, le)} {count}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels_text(key, le)} {row[-1]}")
+            lines.append(f"{self.name}_sum{_labels_text(key)} {row[-2]}")
+            lines.append(f"{self.name}_count{_labels_text(key)} {row[-1]}")
+        return lines
+
+
+class MetricCallback(Metric):
+    """Значения считываются в момент запроса /metrics: fn() -> {метки: значение} или число"""
+
+    def __init__(self, name: str, help_text: str, kind: str, fn):
+        super().__init__(name, help_text)
+        self.kind = kind
+        self.fn = fn
+
+    def samples(self) -> list[str]:
+        try:
+            values = self.fn()
+        except Exception:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_labels_text(k)} {v}" for k, v in values.items()]
+
+
+metrics_registry: list[Metric] = []
+
+HANDLER_SECONDS = MetricHistogram("bot_handler_seconds", "Время от входа апдейта в хендлер до ответа")
+STAGE_SECONDS   = MetricHistogram("bot_stage_seconds", "Время хендлера по этапам: db, llm, telegram, other")
+RATE_LIMITED    = MetricCounter("bot_rate_limited_total", "Сообщения, отбитые rate limit")
+ERRORS          = MetricCounter("bot_errors_total", "Ошибки по типам")
+ANSWERS         = MetricCounter("bot_answers_total", "Ответы по источнику: llm, cache, codex")
+
+
+def render_metrics() -> str:
+    return "\n".join(m.render() for m in metrics_registry) + "\n"
+
+
+class RequestTimer:
+    """Время хендлера по этапам. Этапы вложенные, но не пересекаются:
+    пока идёт telegram внутри llm (правки стрима), время llm не тикает."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.totals: dict[str, float] = defaultdict(float)
+        self.stack: list[list] = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        now = time.perf_counter()
+        if self.stack:
+            self.totals[self.stack[-1][0]] += now - self.stack[-1][1]
+        self.stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            current, since = self.stack.pop()
+            self.totals[current] += now - since
+            if self.stack:
+                self.stack[-1][1] = now
+
+    def observe(self, handler: str) -> float:
+        total = time.perf_counter() - self.started
+        HANDLER_SECONDS.observe(total, handler=handler)
+        for name, seconds in self.totals.items():
+            STAGE_SECONDS.observe(seconds, handler=handler, stage=name)
+        STAGE_SECONDS.observe(max(0.0, total - sum(self.totals.values())), handler=handler, stage="other")
+        return total
+
+
+current_timer: contextvars.ContextVar[RequestTimer | None] = contextvars.ContextVar("current_timer", default=None)
+
+
+def stage(name: str):
+    """with stage("db"): ... — учитывает время в таймере текущего апдейта (если он есть)"""
+    timer = current_timer.get()
+    return timer.stage(name) if timer else contextlib.nullcontext()
+
+
+# Профилирование: админ включает /profile <доля>, и часть вызовов хендлеров идёт под cProfile.
+# Профайлер один на поток, поэтому одновременно профилируется только один вызов, и в отчёт
+# попадает всё, что loop делал, пока хендлер ждал (это видно по asyncio в топе).
+profile_state = {"rate": 0.0, "busy": False, "samples": 0, "stats": None}
+
+
+async def run_profiled(handler, update, context):
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    profile_state["busy"] = True
+    profiler.enable()
+    try:
+        return await handler(update, context)
+    finally:
+        profiler.disable()
+        profile_state["busy"] = False
+        profile_state["samples"] += 1
+        if profile_state["stats"] is None:
+            profile_state["stats"] = pstats.Stats(profiler)
+        else:
+            profile_state["stats"].add(profiler)
+
+
+def instrumented(name: str, handler):
+    """Обёртка хендлера: таймер этапов, гистограммы, ошибки, JSON-лог и выборочный cProfile"""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        timer = RequestTimer()
+        token = current_timer.set(timer)
+        try:
+            if profile_state["rate"] and not profile_state["busy"] and random.random() < profile_state["rate"]:
+                await run_profiled(handler, update, context)
+            else:
+                await handler(update, context)
+        except Exception as error:
+            ERRORS.inc(type=type(error).__name__)
+            raise
+        finally:
+            current_timer.reset(token)
+            total = timer.observe(name)
+            log.info("update", extra={"fields": {
+                "handler": name,
+                "user_id": update.effective_user.id if update.effective_user else None,
+                "ms": round(total * 1000),
+                **{f"{k}_ms": round(v * 1000) for k, v in timer.totals.items()},
+            }})
+    return wrapper
+
+
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    log.error("Необработанная ошибка", exc_info=context.error)
+
+
+metrics_runner = None
+
+
+async def start_metrics_server(application):
+    """GET /metrics в формате Prometheus на METRICS_PORT (0 — выключено)"""
+    global metrics_runner
+    if not METRICS_PORT:
+        return
+    from aiohttp import web
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(text=render_metrics(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    log.info(f"✅ Метрики на :{METRICS_PORT}/metrics")
+
+
+async def stop_metrics_server():
+    global metrics_runner
+    if metrics_runner:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+
 # ──────────────────────────────────────────
 # БД
 # ──────────────────────────────────────────
 db_pool = None
 
+# Миграции: (версия, в транзакции ли, SQL). Применённые версии пишутся в schema_version.
+# CREATE INDEX CONCURRENTLY не работает внутри транзакции — такие шаги идут без неё,
+# зато не блокируют запись в большие таблицы.
+INDEX_MIGRATION = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS questions_user_id_idx ON questions (user_id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_questions_idx ON users (questions DESC)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_active_idx ON users (user_id) WHERE blocked = FALSE",
+]
+MIGRATIONS = [
+    (1, True, ["""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id    BIGINT PRIMARY KEY,
+            username   TEXT,
+            first_name TEXT,
+            joined_at  TIMESTAMP DEFAULT NOW(),
+            questions  INT DEFAULT 0,
+            blocked    BOOLEAN DEFAULT FALSE
+        );
+        CREATE TABLE IF NOT EXISTS questions (
+            id         SERIAL PRIMARY KEY,
+            user_id    BIGINT,
+            question   TEXT,
+            answer     TEXT,
+            rating     SMALLINT,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+        ALTER TABLE questions
+            ADD COLUMN IF NOT EXISTS prompt_tokens     INT,
+            ADD COLUMN IF NOT EXISTS completion_tokens INT,
+            ADD COLUMN IF NOT EXISTS latency_ms        INT;
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id                SERIAL PRIMARY KEY,
+            text              TEXT,
+            admin_chat_id     BIGINT,
+            status_message_id BIGINT,
+            cursor            BIGINT DEFAULT 0,
+            sent              INT DEFAULT 0,
+            failed            INT DEFAULT 0,
+            blocked           INT DEFAULT 0,
+            status            TEXT DEFAULT 'running',
+            created_at        TIMESTAMP DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            id         BIGSERIAL PRIMARY KEY,
+            user_id    BIGINT,
+            role       TEXT,
+            content    TEXT,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS history_user_id_idx ON history (user_id, id);
+    """]),
+    (2, False, INDEX_MIGRATION),
+    (3, True, ["""
+        -- Счётчики для /admin, которые ведут триггеры уровня statement
+        CREATE TABLE IF NOT EXISTS stats (
+            id              INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+            total_users     BIGINT NOT NULL DEFAULT 0,
+            total_questions BIGINT NOT NULL DEFAULT 0,
+            rating_sum      BIGINT NOT NULL DEFAULT 0,
+            rating_count    BIGINT NOT NULL DEFAULT 0
+        );
+
+        CREATE OR REPLACE FUNCTION stats_users_insert() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats SET total_users = total_users + (SELECT COUNT(*) FROM new_rows);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION stats_users_delete() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats SET total_users = total_users - (SELECT COUNT(*) FROM old_rows);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION stats_questions_insert() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats SET
+                total_questions = total_questions + (SELECT COUNT(*) FROM new_rows),
+                rating_sum      = rating_sum   + (SELECT COALESCE(SUM(rating), 0) FROM new_rows),
+                rating_count    = rating_count + (SELECT COUNT(rating) FROM new_rows);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION stats_questions_update() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats SET
+                rating_sum   = rating_sum   + (SELECT COALESCE(SUM(rating), 0) FROM new_rows)
+                                            - (SELECT COALESCE(SUM(rating), 0) FROM old_rows),
+                rating_count = rating_count + (SELECT COUNT(rating) FROM new_rows)
+                                            - (SELECT COUNT(rating) FROM old_rows);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION stats_questions_delete() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats SET
+                total_questions = total_questions - (SELECT COUNT(*) FROM old_rows),
+                rating_sum      = rating_sum   - (SELECT COALESCE(SUM(rating), 0) FROM old_rows),
+                rating_count    = rating_count - (SELECT COUNT(rating) FROM old_rows);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER stats_users_insert AFTER INSERT ON users
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE stats_users_insert();
+        CREATE TRIGGER stats_users_delete AFTER DELETE ON users
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE stats_users_delete();
+        CREATE TRIGGER stats_questions_insert AFTER INSERT ON questions
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE stats_questions_insert();
+        CREATE TRIGGER stats_questions_update AFTER UPDATE ON questions
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE stats_questions_update();
+        CREATE TRIGGER stats_questions_delete AFTER DELETE ON questions
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE stats_questions_delete();
+
+        -- Триггеры уже держат блокировку таблиц, так что стартовый пересчёт ничего не потеряет
+        INSERT INTO stats (id, total_users, total_questions, rating_sum, rating_count)
+        SELECT 1,
+               (SELECT COUNT(*) FROM users),
+               COUNT(*), COALESCE(SUM(rating), 0), COUNT(rating)
+        FROM questions
+        ON CONFLICT (id) DO NOTHING;
+    """]),
+    (4, True, ["""
+        -- Общее состояние реплик: без WAL, после падения Postgres его не жалко
+        CREATE UNLOGGED TABLE IF NOT EXISTS rate_limits (
+            user_id BIGINT PRIMARY KEY,
+            last_at TIMESTAMPTZ NOT NULL
+        );
+        CREATE UNLOGGED TABLE IF NOT EXISTS sessions (
+            user_id          BIGINT PRIMARY KEY,
+            last_question_id BIGINT,
+            updated_at       TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """]),
+    # Повтор 2: раньше прерванная сборка оставляла INVALID-индекс, и версия 2 записывалась с ним
+    (5, False, INDEX_MIGRATION),
+    # Оценка приходит с question_id в callback_data — последний вопрос пользователя хранить незачем
+    (6, True, ["DROP TABLE IF EXISTS sessions"]),
+    (7, True, ["""
+        -- Одна строка stats держала блокировку до коммита каждого батча — запись реплик шла гуськом.
+        -- Счётчики раскладываем на 16 строк: соединение пишет в свою (по pid бэкенда), get_stats суммирует.
+        ALTER TABLE stats DROP CONSTRAINT IF EXISTS stats_id_check;
+        ALTER TABLE stats ALTER COLUMN id DROP DEFAULT;
+        INSERT INTO stats (id) SELECT g FROM generate_series(0, 15) g ON CONFLICT (id) DO NOTHING;
+
+        CREATE OR REPLACE FUNCTION stats_shard() RETURNS INT AS $$
+            SELECT pg_backend_pid() % 16
+        $$ LANGUAGE sql STABLE;
+
+        CREATE OR REPLACE FUNCTION stats_users_insert() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats SET total_users = total_users + (SELECT COUNT(*) FROM new_rows)
+            WHERE id = stats_shard();
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION stats_users_delete() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats SET total_users = total_users - (SELECT COUNT(*) FROM old_rows)
+            WHERE id = stats_shard();
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION stats_questions_insert() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats SET
+                total_questions = total_questions + (SELECT COUNT(*) FROM new_rows),
+                rating_sum      = rating_sum   + (SELECT COALESCE(SUM(rating), 0) FROM new_rows),
+                rating_count    = rating_count + (SELECT COUNT(rating) FROM new_rows)
+            WHERE id = stats_shard();
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION stats_questions_update() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats SET
+                rating_sum   = rating_sum   + (SELECT COALESCE(SUM(rating), 0) FROM new_rows)
+                                            - (SELECT COALESCE(SUM(rating), 0) FROM old_rows),
+                rating_count = rating_count + (SELECT COUNT(rating) FROM new_rows)
+                                            - (SELECT COUNT(rating) FROM old_rows)
+            WHERE id = stats_shard();
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION stats_questions_delete() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats SET
+                total_questions = total_questions - (SELECT COUNT(*) FROM old_rows),
+                rating_sum      = rating_sum   - (SELECT COALESCE(SUM(rating), 0) FROM old_rows),
+                rating_count    = rating_count - (SELECT COUNT(rating) FROM old_rows)
+            WHERE id = stats_shard();
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+    """]),
+]
+MIGRATIONS_LOCK = 727_001  # pg_advisory_lock: реплики не мигрируют одновременно
+
+
+async def schema_is_current(conn) -> bool:
+    try:
+        current = await conn.fetchval("SELECT MAX(version) FROM schema_version")
+    except asyncpg.UndefinedTableError:
+        return False
+    return (current or 0) >= MIGRATIONS[-1][0]
+
+
+async def drop_invalid_index(conn, sql: str):
+    """Прерванный CREATE INDEX CONCURRENTLY оставляет INVALID-индекс, а IF NOT EXISTS
+    его потом пропускает — планировщик же такой индекс не использует. Сносим и строим заново."""
+    match = re.match(r"\s*CREATE INDEX CONCURRENTLY IF NOT EXISTS (\w+)", sql)
+    if not match:
+        return
+    invalid = await conn.fetchval("""
+        SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = $1 AND pg_table_is_visible(c.oid)
+    """, match[1])
+    if invalid:
+        log.warning(f"⚠️ Индекс {match[1]} невалиден (прерванная сборка), пересоздаём")
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {match[1]}")
+
+
+async def migrate_db(conn):
+    """conn — отдельное соединение без command_timeout: сборка индексов на больших таблицах
+    и ожидание advisory lock за другой репликой легко идут дольше DB_COMMAND_TIMEOUT"""
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK)
+    try:
+        await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INT PRIMARY KEY)")
+        current = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        for version, transactional, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            async with (conn.transaction() if transactional else contextlib.nullcontext()):
+                for sql in statements:
+                    if not transactional:
+                        await drop_invalid_index(conn, sql)
+                    await conn.execute(sql)
+                await conn.execute("INSERT INTO schema_version (version) VALUES ($1)", version)
+            log.info(f"✅ Миграция БД {version} применена")
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK)
+
+
 async def init_db():
-    global db_pool
+    """БД недоступна на старте — не падаем: работаем из памяти, а пул создаст db_health_loop"""
     if not DATABASE_URL:
-        print("⚠️ DATABASE_URL не задан, работаем без БД")
+        log.warning("⚠️ DATABASE_URL не задан, работаем без БД")
         return
-    db_pool = await asyncpg.create_pool(DATABASE_URL, ssl="require")
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id    BIGINT PRIMARY KEY,
-                username   TEXT,
-                first_name TEXT,
-                joined_at  TIMESTAMP DEFAULT NOW(),
-                questions  INT DEFAULT 0,
-                blocked    BOOLEAN DEFAULT FALSE
-            );
-            CREATE TABLE IF NOT EXISTS questions (
-                id         SERIAL PRIMARY KEY,
-                user_id    BIGINT,
-                question   TEXT,
-                answer     TEXT,
-                rating     SMALLINT,
-                created_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
-    print("✅ БД подключена")
+    try:
+        await connect_db()
+    except DB_DOWN_ERRORS as error:
+        db_failed(error)
 
 
-async def save_user(user_id: int, username: str, first_name: str):
+async def connect_db():
+    global db_pool
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        ssl=DB_SSL,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        statement_cache_size=DB_STATEMENT_CACHE,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        timeout=DB_CONNECT_TIMEOUT,
+        max_inactive_connection_lifetime=DB_IDLE_LIFETIME,
+        server_settings={"application_name": "sokrat-bot"},
+    )
+    try:
+        # Обычный рестарт: схема свежая — ни блокировки, ни DDL, один SELECT
+        async with pool.acquire() as conn:
+            current = await schema_is_current(conn)
+        if not current:
+            conn = await asyncpg.connect(
+                DATABASE_URL, ssl=DB_SSL, timeout=DB_CONNECT_TIMEOUT,
+                server_settings={"application_name": "sokrat-bot-migrate"},
+            )
+            try:
+                await migrate_db(conn)
+            finally:
+                await conn.close()
+    except BaseException:
+        await pool.close()
+        raise
+    db_pool = pool
+    log.info(f"✅ БД подключена, пул {DB_POOL_MIN}..{DB_POOL_MAX}")
+
+
+# Горячие запросы — неизменный текст: asyncpg готовит его один раз на соединение и держит
+# в LRU-кэше на DB_STATEMENT_CACHE запросов, дальше по сети идут только Bind/Execute.
+# Собранный на лету SQL (f-строки, разный порядок колонок) кэш бы промахивал.
+HOT_SQL = {
+    "upsert_users": """
+        INSERT INTO users (user_id, username, first_name)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (user_id) DO UPDATE
+        SET username=$2, first_name=$3, blocked=FALSE
+    """,
+    "increment_questions": "UPDATE users SET questions = questions + $2 WHERE user_id = $1",
+    "reserve_question_ids": (
+        "SELECT nextval(pg_get_serial_sequence('questions', 'id')) AS id FROM generate_series(1, $1)"
+    ),
+    "save_ratings": "UPDATE questions SET rating=$2 WHERE id=$1",
+    "user_stats": "SELECT questions, joined_at FROM users WHERE user_id=$1",
+    # Пропускает и запоминает запрос одной командой: строка вернётся, только если окно истекло
+    "rate_limit_hit": """
+        INSERT INTO rate_limits AS r (user_id, last_at) VALUES ($1, NOW())
+        ON CONFLICT (user_id) DO UPDATE SET last_at = EXCLUDED.last_at
+        WHERE r.last_at <= EXCLUDED.last_at - make_interval(secs => $2)
+        RETURNING 1
+    """,
+}
+
+
+# ──────────────────────────────────────────
+# ДЕГРАДАЦИЯ БД
+# ──────────────────────────────────────────
+# Пока БД лежит или тормозит, бот отвечает из памяти, а записи копятся в очереди write-behind.
+# Фоновая проверка раз в DB_HEALTH_INTERVAL возвращает всё в норму и будит запись.
+DB_DOWN_ERRORS = (
+    OSError, asyncio.TimeoutError, asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError, asyncpg.CannotConnectNowError,
+)
+db_state = {"healthy": True, "since": 0.0, "failures": 0}
+health_task: asyncio.Task | None = None
+
+
+def db_available() -> bool:
+    return db_pool is not None and db_state["healthy"]
+
+
+def db_failed(error: BaseException):
+    db_state["failures"] += 1
+    if db_state["healthy"]:
+        db_state.update(healthy=False, since=time.monotonic())
+        log.warning(f"⚠️ БД недоступна ({type(error).__name__}: {error}), работаем из памяти")
+
+
+async def db_health_loop(on_connect):
+    while True:
+        await asyncio.sleep(DB_HEALTH_INTERVAL)
+        if db_pool is None:
+            await connect_late(on_connect)
+            continue
+        try:
+            await db_pool.fetchval("SELECT 1", timeout=DB_CONNECT_TIMEOUT)
+        except DB_DOWN_ERRORS as error:
+            db_failed(error)
+            continue
+        if not db_state["healthy"]:
+            db_state["healthy"] = True
+            log.info(f"✅ БД снова доступна, в очереди {pending_rows()} строк")
+            write_wakeup.set()
+
+
+async def connect_late(on_connect):
+    """Бот стартовал без БД: создаём пул, мигрируем и догоняем то, что пропустили на старте"""
+    try:
+        await connect_db()
+    except DB_DOWN_ERRORS as error:
+        db_failed(error)
+        return
+    except Exception:
+        log.exception("Не удалось подключить БД, попробую ещё раз")
+        return
+    db_state["healthy"] = True
+    log.info(f"✅ БД подключилась после старта, в очереди {pending_rows()} строк")
+    write_wakeup.set()
+    try:
+        await on_connect()
+    except Exception:
+        log.exception("Ошибка при подготовке после подключения БД")
+
+
+def start_db_health(on_connect):
+    """on_connect — что догнать, если пул создастся уже после старта"""
+    global health_task
+    if DATABASE_URL and health_task is None:
+        health_task = asyncio.create_task(db_health_loop(on_connect))
+
+
+async def stop_db_health():
+    global health_task
+    if health_task:
+        health_task.cancel()
+        try:
+            await health_task
+        except asyncio.CancelledError:
+            pass
+        health_task = None
+
+
+def db_status_text() -> str:
+    if not DATABASE_URL:
+        return "нет"
     if not db_pool:
+        return f"не подключена с запуска, сбоев {db_state['failures']}"
+    state = "ok" if db_state["healthy"] else f"недоступна {time.monotonic() - db_state['since']:.0f} с"
+    return f"{state}, пул {db_pool.get_size() - db_pool.get_idle_size()}/{db_pool.get_size()}, сбоев {db_state['failures']}"
+
+
+MetricCallback("bot_db_up", "БД доступна (1) или бот в деградации (0)", "gauge", lambda: int(db_available()))
+
+
+# ──────────────────────────────────────────
+# ОТЛОЖЕННАЯ ЗАПИСЬ (write-behind)
+# ──────────────────────────────────────────
+# Хендлеры только кладут изменения в очередь, а фоновая задача
+# сбрасывает их в БД пачками раз в WRITE_FLUSH_INTERVAL или по WRITE_FLUSH_ROWS.
+pending_users: dict[int, tuple[str, str]] = {}         # user_id -> (username, first_name)
+pending_increments: dict[int, int]        = defaultdict(int)
+pending_questions: list[tuple]            = []         # (id, user_id, question, answer, токены, latency_ms)
+pending_ratings: dict[int, int]           = {}         # question_id -> rating
+known_users: OrderedDict[int, tuple[str, str]] = OrderedDict()  # LRU: что уже в БД — лишний upsert не нужен
+question_ids: deque                       = deque()    # заранее выделенные id вопросов
+pending_history: list[tuple]              = []         # (user_id, role, content)
+pending_history_clears: set[int]          = set()
+
+history_in_flight: dict[asyncio.Future, set[int]] = {}  # батчи истории, которые пишутся прямо сейчас
+history_flush_seq = 0
+
+write_wakeup = asyncio.Event()
+write_task: asyncio.Task | None = None
+write_stats = {"flushes": 0, "rows": 0, "errors": 0, "dropped": 0}
+
+MetricCallback("bot_db_pool_connections", "Соединения asyncpg", "gauge", lambda: {
+    (("state", "total"),): db_pool.get_size() if db_pool else 0,
+    (("state", "idle"),): db_pool.get_idle_size() if db_pool else 0,
+})
+
+
+def pending_rows() -> int:
+    return (
+        len(pending_users) + len(pending_increments) + len(pending_questions)
+        + len(pending_ratings) + len(pending_history) + len(pending_history_clears)
+    )
+
+
+MetricCallback("bot_pending_writes", "Строки в очереди записи в БД", "gauge", lambda: pending_rows())
+
+
+def _schedule_flush():
+    rows = pending_rows()
+    if rows > WRITE_QUEUE_MAX:
+        _trim_pending(rows - WRITE_QUEUE_MAX)
+    if rows >= WRITE_FLUSH_ROWS and db_available():
+        write_wakeup.set()
+
+
+def _trim_pending(excess: int):
+    """БД лежит слишком долго: сначала жертвуем историей (она есть в памяти), потом старыми вопросами"""
+    dropped = min(excess, len(pending_history))
+    del pending_history[:dropped]
+    if excess > dropped:
+        n = min(excess - dropped, len(pending_questions))
+        del pending_questions[:n]
+        dropped += n
+    if dropped:
+        if not write_stats["dropped"]:
+            log.error(f"⚠️ Очередь записи переполнена ({WRITE_QUEUE_MAX} строк), старые строки отбрасываются")
+        write_stats["dropped"] += dropped
+
+
+async def save_user(user_id: int, username: str, first_name: str):
+    if not DATABASE_URL:
         return
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO users (user_id, username, first_name)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (user_id) DO UPDATE
-            SET username=$2, first_name=$3
-        """, user_id, username or "", first_name or "")
+    data = (username or "", first_name or "")
+    if pending_users.get(user_id) == data:
+        return
+    if known_users.get(user_id) == data:
+        known_users.move_to_end(user_id)
+        return
+    pending_users[user_id] = data
+    _schedule_flush()
+
+
+def remember_users(users: dict[int, tuple[str, str]]):
+    for user_id, data in users.items():
+        known_users[user_id] = data
+        known_users.move_to_end(user_id)
+    while len(known_users) > KNOWN_USERS_MAX:
+        known_users.popitem(last=False)
 
 
 async def increment_questions(user_id: int):
-    if not db_pool:
+    if not DATABASE_URL:
         return
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE users SET questions = questions + 1 WHERE user_id = $1",
-            user_id
-        )
+    pending_increments[user_id] += 1
+    _schedule_flush()
 
 
-async def save_question(user_id: int, question: str, answer: str) -> int:
-    """Сохраняет вопрос и возвращает его ID"""
-    if not db_pool:
+async def next_question_id() -> int:
+    """Id берётся из sequence блоками по QUESTION_ID_BLOCK — кнопкам рейтинга он нужен сразу.
+    Без БД — 0: вопрос всё равно запишется (id выдаст БД), но оценить его будет нельзя."""
+    if not question_ids:
+        if not db_available():
+            return 0
+        try:
+            async with db_pool.acquire() as conn:
+                rows = await conn.fetch(HOT_SQL["reserve_question_ids"], QUESTION_ID_BLOCK)
+        except DB_DOWN_ERRORS as error:
+            db_failed(error)
+            return 0
+        question_ids.extend(r["id"] for r in rows)
+    return question_ids.popleft()
+
+
+async def save_question(user_id: int, question: str, answer: str, usage: dict | None = None) -> int:
+    """Сохраняет вопрос (и расход токенов из usage) и возвращает его ID"""
+    if not DATABASE_URL:
         return 0
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "INSERT INTO questions (user_id, question, answer) VALUES ($1, $2, $3) RETURNING id",
-            user_id, question, answer
-        )
-        return row["id"]
+    usage = usage or {}
+    question_id = await next_question_id()
+    pending_questions.append((
+        question_id, user_id, question, answer,
+        usage.get("prompt_tokens"), usage.get("completion_tokens"), usage.get("latency_ms")
+    ))
+    _schedule_flush()
+    return question_id
 
 
 async def save_rating(question_id: int, rating: int):
-    if not db_pool:
+    if not DATABASE_URL:
         return
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE questions SET rating=$1 WHERE id=$2",
-            rating, question_id
+    pending_ratings[question_id] = rating
+    _schedule_flush()
+
+
+async def _write_rows(conn, users=(), increments=(), questions=(), ratings=(), clears=(), history=()):
+    if users:
+        await conn.executemany(HOT_SQL["upsert_users"], [(uid, u, f) for uid, (u, f) in users.items()])
+    if increments:
+        await conn.executemany(HOT_SQL["increment_questions"], list(increments.items()))
+    columns = ["user_id", "question", "answer", "prompt_tokens", "completion_tokens", "latency_ms"]
+    numbered = [q for q in questions if q[0]]
+    if numbered:
+        await conn.copy_records_to_table("questions", records=numbered, columns=["id", *columns])
+    unnumbered = [q[1:] for q in questions if not q[0]]  # записаны, пока БД была недоступна
+    if unnumbered:
+        await conn.copy_records_to_table("questions", records=unnumbered, columns=columns)
+    if ratings:
+        await conn.executemany(HOT_SQL["save_ratings"], list(ratings.items()))
+    if clears:
+        await conn.execute("DELETE FROM history WHERE user_id = ANY($1::bigint[])", list(clears))
+    if history:
+        await conn.copy_records_to_table(
+            "history", records=history, columns=["user_id", "role", "content"]
         )
+        # В БД держим только последние MAX_HISTORY сообщений пользователя
+        await conn.execute("""
+            DELETE FROM history WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY id DESC) AS rn
+                    FROM history WHERE user_id = ANY($1::bigint[])
+                ) t WHERE rn > $2
+            )
+        """, list({h[0] for h in history}), MAX_HISTORY)
+
+
+def _batch_size(batch: dict) -> int:
+    return sum(len(rows) for rows in batch.values())
+
+
+def _requeue(batch: dict):
+    """Возвращает батч в очередь — более свежие данные не затираем"""
+    global pending_history_clears
+    for uid, data in batch.get("users", {}).items():
+        pending_users.setdefault(uid, data)
+    for uid, n in batch.get("increments", {}).items():
+        pending_increments[uid] += n
+    pending_questions[:0] = batch.get("questions", [])
+    for qid, r in batch.get("ratings", {}).items():
+        pending_ratings.setdefault(qid, r)
+    # Очистка, пришедшая позже, отменяет старые сообщения этого пользователя
+    pending_history[:0] = [h for h in batch.get("history", []) if h[0] not in pending_history_clears]
+    pending_history_clears |= batch.get("clears", set())
+
+
+def _single_rows(batch: dict):
+    """Батч по одной строке: (ключ, мини-батч) в том же порядке, что и _write_rows"""
+    for key, rows in batch.items():
+        if isinstance(rows, dict):
+            for k, v in rows.items():
+                yield key, {key: {k: v}}
+        else:
+            for row in rows:
+                yield key, {key: {row} if isinstance(rows, set) else [row]}
+
+
+async def _salvage_batch(batch: dict):
+    """Батч упал не из-за связи с БД — значит, виновата конкретная строка (например,
+    подделанный callback_data). Пишем по одной строке, битые выкидываем, остальное сохраняем."""
+    items = list(_single_rows(batch))
+    done = 0
+    try:
+        async with db_pool.acquire() as conn:
+            for key, row in items:
+                try:
+                    async with conn.transaction():
+                        await _write_rows(conn, **row)
+                except DB_DOWN_ERRORS:
+                    raise
+                except Exception as error:
+                    write_stats["dropped"] += 1
+                    log.error(f"Строка {key} не записана и отброшена: {error}: {row[key]!r:.200}")
+                else:
+                    if key == "users":
+                        remember_users(row[key])
+                    write_stats["rows"] += 1
+                done += 1
+    except (Exception, asyncio.CancelledError) as error:
+        if isinstance(error, DB_DOWN_ERRORS):
+            db_failed(error)
+        rest: dict = {}
+        for key, row in items[done:]:
+            part = row[key]
+            if isinstance(part, dict):
+                rest.setdefault(key, {}).update(part)
+            elif isinstance(part, set):
+                rest.setdefault(key, set()).update(part)
+            else:
+                rest.setdefault(key, []).extend(part)
+        _requeue(rest)
+        raise
+
+
+async def flush_writes():
+    """Один батч: upsert пользователей, COPY вопросов, счётчики и оценки — в одной транзакции"""
+    global pending_users, pending_increments, pending_questions, pending_ratings
+    global pending_history, pending_history_clears
+    if not db_pool or not pending_rows():
+        return
+    batch = {
+        "users": pending_users, "increments": pending_increments,
+        "questions": pending_questions, "ratings": pending_ratings,
+        "clears": pending_history_clears, "history": pending_history,
+    }
+    pending_users, pending_increments = {}, defaultdict(int)
+    pending_questions, pending_ratings = [], {}
+    pending_history, pending_history_clears = [], set()
+
+    # Пока батч пишется, его строк нет ни в очереди, ни (до COMMIT) в таблице —
+    # загрузка истории этих пользователей дождётся конца записи
+    global history_flush_seq
+    users = {h[0] for h in batch["history"]} | batch["clears"]
+    done = asyncio.get_running_loop().create_future()
+    if users:
+        history_flush_seq += 1
+        history_in_flight[done] = users
+    try:
+        await _flush_batch(batch)
+    finally:
+        history_in_flight.pop(done, None)
+        done.set_result(None)
+
+
+async def _flush_batch(batch: dict):
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                await _write_rows(conn, **batch)
+    except (*DB_DOWN_ERRORS, asyncio.CancelledError) as error:
+        write_stats["errors"] += 1
+        if isinstance(error, DB_DOWN_ERRORS):
+            db_failed(error)
+        _requeue(batch)
+        raise
+    except Exception as error:
+        # Ретраить такой батч целиком бессмысленно: одна плохая строка заблокирует всю запись
+        write_stats["errors"] += 1
+        log.error(f"Ошибка записи в БД: {error} — пишем батч построчно")
+        await _salvage_batch(batch)
+        write_stats["flushes"] += 1
+        return
+
+    remember_users(batch["users"])
+    write_stats["flushes"] += 1
+    write_stats["rows"] += _batch_size(batch)
+
+
+async def write_behind_loop():
+    while True:
+        try:
+            await asyncio.wait_for(write_wakeup.wait(), timeout=WRITE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        write_wakeup.clear()
+        if not db_available():
+            continue  # ждём, пока db_health_loop не увидит БД живой
+        try:
+            await flush_writes()
+        except Exception:
+            await asyncio.sleep(WRITE_FLUSH_INTERVAL)
+
+
+def start_write_behind():
+    global write_task
+    if DATABASE_URL and write_task is None:
+        write_task = asyncio.create_task(write_behind_loop())
+
+
+async def stop_write_behind():
+    """Останавливает фоновую задачу и сбрасывает хвост очереди"""
+    global write_task
+    if write_task:
+        write_task.cancel()
+        try:
+            await write_task
+        except asyncio.CancelledError:
+            pass
+        write_task = None
+    try:
+        await flush_writes()
+    except Exception:
+        pass
+    if pending_rows():
+        log.error(f"⚠️ Не записано в БД при остановке: {pending_rows()} строк")
+
+
+async def _fetch(sql: str, *args) -> list:
+    async with db_pool.acquire() as conn:
+        return await conn.fetch(sql, *args)
+
+
+async def _fetchrow(sql: str, *args):
+    async with db_pool.acquire() as conn:
+        return await conn.fetchrow(sql, *args)
 
 
 async def get_stats() -> dict:
+    """Счётчики — сумма строк stats (их ведут триггеры), топ — по индексу users_questions_idx.
+    Оба запроса идут параллельно на разных соединениях пула."""
     if not db_pool:
         return {}
+    summary, top_users = await asyncio.gather(
+        _fetchrow("""
+            SELECT COALESCE(SUM(total_users), 0)::bigint  AS total_users,
+                   COALESCE(SUM(total_questions), 0)::bigint AS total_questions,
+                   COALESCE(SUM(rating_sum), 0)::bigint   AS rating_sum,
+                   COALESCE(SUM(rating_count), 0)::bigint AS rating_count
+            FROM stats
+        """),
+        _fetch("SELECT first_name, questions FROM users ORDER BY questions DESC LIMIT 5"),
+    )
+    summary = summary or {"total_users": 0, "total_questions": 0, "rating_sum": 0, "rating_count": 0}
+    avg_rating = round(summary["rating_sum"] / summary["rating_count"], 1) if summary["rating_count"] else 0
+    return {
+        "total_users": summary["total_users"],
+        "total_questions": summary["total_questions"],
+        "avg_rating": avg_rating,
+        "top_users": top_users
+    }
+
+
+async def get_user_stats(user_id: int) -> dict:
+    if not db_available():
+        return {"questions": "—" if DATABASE_URL else 0, "joined_at": "—"}
+    try:
+        async with db_pool.acquire() as conn:
+            row = await conn.fetchrow(HOT_SQL["user_stats"], user_id)
+    except DB_DOWN_ERRORS as error:
+        db_failed(error)
+        return {"questions": "—", "joined_at": "—"}
+    if row:
+        return {"questions": row["questions"], "joined_at": row["joined_at"].strftime("%d.%m.%Y")}
+    return {"questions": 0, "joined_at": "—"}
+
+
+async def create_broadcast(text: str, admin_chat_id: int, status_message_id: int) -> dict:
     async with db_pool.acquire() as conn:
-        total_users     = await conn.fetchval("SELECT COUNT(*) FROM users")
-        total_questions = await conn.fetchval("SELECT COUNT(*) FROM questions")
-        avg_rating      = await conn.fetchval("SELECT ROUND(AVG(rating),1) FROM questions WHERE rating IS NOT NULL")
-        top_users       = await conn.fetch(
-            "SELECT first_name, questions FROM users ORDER BY questions DESC LIMIT 5"
+        row = await conn.fetchrow(
+            "INSERT INTO broadcasts (text, admin_chat_id, status_message_id) "
+            "VALUES ($1, $2, $3) RETURNING *",
+            text, admin_chat_id, status_message_id
         )
-        return {
-            "total_users": total_users,
-            "total_questions": total_questions,
-            "avg_rating": avg_rating or 0,
-            "top_users": top_users
-        }
+        return dict(row)
 
 
-async def get_all_user_ids() -> list:
+async def get_running_broadcasts() -> list[dict]:
     if not db_pool:
         return []
     async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT user_id FROM users WHERE blocked=FALSE")
+        rows = await conn.fetch("SELECT * FROM broadcasts WHERE status='running' ORDER BY id")
+        return [dict(r) for r in rows]
+
+
+async def save_broadcast_progress(b: dict, blocked_ids: list[int]):
+    """Сохраняет курсор рассылки и помечает заблокировавших бота"""
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            if blocked_ids:
+                await conn.execute(
+                    "UPDATE users SET blocked=TRUE WHERE user_id = ANY($1::bigint[])",
+                    blocked_ids
+                )
+            await conn.execute(
+                "UPDATE broadcasts SET cursor=$2, sent=$3, failed=$4, blocked=$5, status=$6 WHERE id=$1",
+                b["id"], b["cursor"], b["sent"], b["failed"], b["blocked"], b["status"]
+            )
+
+
+async def get_user_ids_after(cursor: int, limit: int) -> list[int]:
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT user_id FROM users WHERE blocked=FALSE AND user_id > $1 ORDER BY user_id LIMIT $2",
+            cursor, limit
+        )
         return [r["user_id"] for r in rows]
 
 
-async def get_user_stats(user_id: int) -> dict:
-    if not db_pool:
-        return {"questions": 0, "joined_at": "—"}
+async def count_user_ids_after(cursor: int) -> int:
     async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT questions, joined_at FROM users WHERE user_id=$1", user_id
+        return await conn.fetchval(
+            "SELECT COUNT(*) FROM users WHERE blocked=FALSE AND user_id > $1", cursor
         )
-        if row:
-            return {"questions": row["questions"], "joined_at": row["joined_at"].strftime("%d.%m.%Y")}
-        return {"questions": 0, "joined_at": "—"}
 
 
 # ──────────────────────────────────────────
 # ПАМЯТЬ (история в RAM)
 # ──────────────────────────────────────────
-histories: dict[int, list]          = defaultdict(list)
-user_last_request: dict[int, float] = defaultdict(float)
-last_question_id: dict[int, int]    = {}  # user_id -> question_id для рейтинга
+user_last_request: dict[int, float]     = {}  # time.monotonic() последнего запроса
+user_inflight: dict[int, list[Message]] = {}  # user_id -> сообщения, пришедшие пока готовится ответ
+coalesce_stats = {"coalesced": 0}
+
+RATE_LIMIT_SECONDS   = 3
+RATE_LIMIT_MAX_USERS = 10000  # дальше чистим протухшие записи
+MAX_HISTORY          = 10
+
+
+class HistoryStore:
+    """История диалогов: последние MAX_HISTORY сообщений на пользователя"""
+
+    async def get(self, user_id: int) -> list[dict]:
+        raise NotImplementedError
+
+    async def append(self, user_id: int, message: dict):
+        raise NotImplementedError
+
+    async def clear(self, user_id: int):
+        raise NotImplementedError
+
+    def stats_text(self) -> str:
+        raise NotImplementedError
+
+
+class MemoryHistoryStore(HistoryStore):
+    """deque(maxlen) на пользователя, сообщения — кортежи (role, content).
+    Вытесняем самых давних по LRU: по простою, по числу пользователей и по памяти."""
+
+    def __init__(self, max_len: int, max_users: int, idle_ttl: float, max_bytes: int):
+        self.max_len   = max_len
+        self.max_users = max_users
+        self.idle_ttl  = idle_ttl
+        self.max_bytes = max_bytes
+        self.items: OrderedDict[int, deque] = OrderedDict()
+        self.touched: dict[int, float] = {}
+        self.bytes   = 0
+        self.evicted = 0
+        self.entry_bytes = sys.getsizeof(deque(maxlen=max_len)) + 100  # deque + записи в словарях
+
+    @staticmethod
+    def _size(item: tuple) -> int:
+        return sys.getsizeof(item[1]) + 64
+
+    def _touch(self, user_id: int, create: bool) -> deque | None:
+        entry = self.items.get(user_id)
+        if entry is None:
+            if not create:
+                return None
+            entry = self.items[user_id] = deque(maxlen=self.max_len)
+            self.bytes += self.entry_bytes
+        else:
+            self.items.move_to_end(user_id)
+        self.touched[user_id] = time.monotonic()
+        return entry
+
+    def _drop(self, user_id: int):
+        entry = self.items.pop(user_id)
+        del self.touched[user_id]
+        self.bytes -= self.entry_bytes + sum(self._size(m) for m in entry)
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.items:
+            oldest = next(iter(self.items))
+            if (now - self.touched[oldest] < self.idle_ttl
+                    and len(self.items) <= self.max_users
+                    and self.bytes <= self.max_bytes):
+                break
+            self._drop(oldest)
+            self.evicted += 1
+
+    def _add(self, user_id: int, role: str, content: str):
+        entry = self._touch(user_id, create=True)
+        if len(entry) == self.max_len:
+            self.bytes -= self._size(entry[0])  # deque сам выкинет самое старое
+        item = (role, content)
+        entry.append(item)
+        self.bytes += self._size(item)
+        self._evict()
+
+    def _fill(self, user_id: int, messages: list[tuple]):
+        self._touch(user_id, create=True)
+        for role, content in messages[-self.max_len:]:
+            self._add(user_id, role, content)
+
+    async def get(self, user_id: int) -> list[dict]:
+        entry = self._touch(user_id, create=False)
+        if entry is None:
+            return []
+        return [{"role": role, "content": content} for role, content in entry]
+
+    async def append(self, user_id: int, message: dict):
+        self._add(user_id, message["role"], message["content"])
+
+    async def clear(self, user_id: int):
+        if user_id in self.items:
+            self._drop(user_id)
+
+    def stats_text(self) -> str:
+        return (
+            f"{len(self.items)} польз., ~{self.bytes // 1024} КБ, "
+            f"вытеснено {self.evicted}"
+        )
+
+
+class PersistentHistoryStore(MemoryHistoryStore):
+    """Память — горячий кэш; при промахе история подгружается из хранилища.
+    Одновременные промахи по одному пользователю ждут одну загрузку, а не грузят дважды."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.loading: dict[int, asyncio.Future] = {}
+
+    async def _load(self, user_id: int) -> list[tuple]:
+        raise NotImplementedError
+
+    async def _save(self, user_id: int, role: str, content: str):
+        raise NotImplementedError
+
+    async def _delete(self, user_id: int):
+        raise NotImplementedError
+
+    async def get(self, user_id: int) -> list[dict]:
+        while user_id not in self.items:
+            pending = self.loading.get(user_id)
+            if pending is not None:
+                await asyncio.shield(pending)
+                continue  # загрузилось — выйдем; упала — попробуем сами
+            future = self.loading[user_id] = asyncio.get_running_loop().create_future()
+            try:
+                messages = await self._load(user_id)
+                if self.loading.get(user_id) is future:  # clear() во время загрузки её отменяет
+                    self._fill(user_id, messages)
+            finally:
+                if self.loading.get(user_id) is future:
+                    del self.loading[user_id]
+                future.set_result(None)
+            break
+        return await super().get(user_id)
+
+    async def append(self, user_id: int, message: dict):
+        await self.get(user_id)
+        await super().append(user_id, message)
+        await self._save(user_id, message["role"], message["content"])
+
+    async def clear(self, user_id: int):
+        self.loading.pop(user_id, None)
+        await super().clear(user_id)
+        await self._delete(user_id)
+
+
+class PostgresHistoryStore(PersistentHistoryStore):
+    """Пишет через write-behind очередь, читает напрямую из пула"""
+
+    async def _load(self, user_id: int) -> list[tuple]:
+        for _ in range(3):
+            for done, users in list(history_in_flight.items()):
+                if user_id in users:
+                    await asyncio.shield(done)  # строки в полёте: ни в очереди, ни в таблице
+            seq = history_flush_seq
+            rows = []
+            if user_id not in pending_history_clears and db_available():
+                try:
+                    async with db_pool.acquire() as conn:
+                        rows = await conn.fetch(
+                            "SELECT role, content FROM history WHERE user_id=$1 ORDER BY id DESC LIMIT $2",
+                            user_id, self.max_len
+                        )
+                except DB_DOWN_ERRORS as error:
+                    db_failed(error)  # без БД — только то, что есть в памяти
+                rows = [(r["role"], r["content"]) for r in reversed(rows)]
+            if seq == history_flush_seq:
+                break  # пока читали, из очереди в таблицу ничего не ушло
+        return rows + [(h[1], h[2]) for h in pending_history if h[0] == user_id]
+
+    async def _save(self, user_id: int, role: str, content: str):
+        pending_history.append((user_id, role, content))
+        _schedule_flush()
+
+    async def _delete(self, user_id: int):
+        pending_history[:] = [h for h in pending_history if h[0] != user_id]
+        pending_history_clears.add(user_id)
+        _schedule_flush()
+
+
+class SqliteHistoryStore(PersistentHistoryStore):
+    """Локальная замена Postgres для разработки: один файл SQLite"""
+
+    def __init__(self, path: str, *args):
+        super().__init__(*args)
+        import sqlite3  # нужен только этому бэкенду
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, role TEXT, content TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS history_user_id_idx ON history (user_id, id)")
+
+    async def _load(self, user_id: int) -> list[tuple]:
+        rows = self.conn.execute(
+            "SELECT role, content FROM history WHERE user_id=? ORDER BY id DESC LIMIT ?",
+            (user_id, self.max_len)
+        ).fetchall()
+        return rows[::-1]
+
+    async def _save(self, user_id: int, role: str, content: str):
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO history (user_id, role, content) VALUES (?, ?, ?)", (user_id, role, content)
+            )
+            self.conn.execute(
+                "DELETE FROM history WHERE user_id=? AND id NOT IN "
+                "(SELECT id FROM history WHERE user_id=? ORDER BY id DESC LIMIT ?)",
+                (user_id, user_id, self.max_len)
+            )
+
+    async def _delete(self, user_id: int):
+        with self.conn:
+            self.conn.execute("DELETE FROM history WHERE user_id=?", (user_id,))
+
+
+def make_history_store() -> HistoryStore:
+    args = (MAX_HISTORY, HISTORY_MAX_USERS, HISTORY_IDLE_TTL, HISTORY_MAX_BYTES)
+    if HISTORY_BACKEND == "postgres" and DATABASE_URL:
+        return PostgresHistoryStore(*args)
+    if HISTORY_BACKEND == "sqlite":
+        return SqliteHistoryStore(HISTORY_SQLITE_PATH, *args)
+    if HISTORY_BACKEND != "memory":
+        log.warning(f"⚠️ HISTORY_BACKEND={HISTORY_BACKEND} недоступен, история только в памяти")
+    return MemoryHistoryStore(*args)
+
+
+history_store: HistoryStore = MemoryHistoryStore(MAX_HISTORY, HISTORY_MAX_USERS, HISTORY_IDLE_TTL, HISTORY_MAX_BYTES)
+
+MetricCallback("bot_history_users", "Пользователи с историей в памяти", "gauge",
+               lambda: len(getattr(history_store, "items", ())))
+MetricCallback("bot_history_bytes", "Оценка памяти под историю", "gauge",
+               lambda: getattr(history_store, "bytes", 0))
+
+
+# ──────────────────────────────────────────
+# ОБЩЕЕ СОСТОЯНИЕ РЕПЛИК
+# ──────────────────────────────────────────
+class StateStore:
+    """Rate limit — то, что должно совпадать на всех репликах"""
+
+    async def hit(self, user_id: int) -> bool:
+        """Атомарно: True и запомнить время, если с прошлого запроса прошло RATE_LIMIT_SECONDS"""
+        raise NotImplementedError
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats_text(self) -> str:
+        raise NotImplementedError
+
+
+class MemoryStateStore(StateStore):
+    """Словари процесса: годится для одной реплики или когда пользователь всегда попадает на свою"""
+
+    async def hit(self, user_id: int) -> bool:
+        now  = time.monotonic()
+        last = user_last_request.get(user_id)
+        if last is not None and now - last < RATE_LIMIT_SECONDS:
+            return False
+        user_last_request[user_id] = now
+        if len(user_last_request) > RATE_LIMIT_MAX_USERS:
+            for uid in [u for u, t in user_last_request.items() if now - t >= RATE_LIMIT_SECONDS]:
+                del user_last_request[uid]
+        return True
+
+    def stats_text(self) -> str:
+        return f"память, лимитов {len(user_last_request)}"
+
+
+class PostgresStateStore(MemoryStateStore):
+    """UNLOGGED-таблица rate_limits: проверка лимита — один INSERT ... ON CONFLICT.
+    Пока БД недоступна, лимит считается локально."""
+
+    def __init__(self):
+        self.sweep_task: asyncio.Task | None = None
+        self.local_hits = 0
+
+    async def hit(self, user_id: int) -> bool:
+        if not db_available():
+            self.local_hits += 1
+            return await super().hit(user_id)
+        try:
+            async with db_pool.acquire() as conn:
+                return await conn.fetchval(HOT_SQL["rate_limit_hit"], user_id, float(RATE_LIMIT_SECONDS)) is not None
+        except DB_DOWN_ERRORS as error:
+            db_failed(error)
+            self.local_hits += 1
+            return await super().hit(user_id)
+
+    async def sweep_loop(self):
+        """TTL: протухшие лимиты чистит любая реплика, повторная чистка ничего не стоит"""
+        while True:
+            await asyncio.sleep(STATE_SWEEP_INTERVAL)
+            if not db_available():
+                continue
+            try:
+                async with db_pool.acquire() as conn:
+                    await conn.execute(
+                        "DELETE FROM rate_limits WHERE last_at < NOW() - make_interval(secs => $1)",
+                        float(RATE_LIMIT_SECONDS)
+                    )
+            except DB_DOWN_ERRORS as error:
+                db_failed(error)
+
+    def start(self):
+        if self.sweep_task is None:
+            self.sweep_task = asyncio.create_task(self.sweep_loop())
+
+    async def stop(self):
+        if self.sweep_task:
+            self.sweep_task.cancel()
+            try:
+                await self.sweep_task
+            except asyncio.CancelledError:
+                pass
+            self.sweep_task = None
+
+    def stats_text(self) -> str:
+        return f"postgres, локальных проверок {self.local_hits}"
+
+
+def make_state_store() -> StateStore:
+    if STATE_BACKEND == "postgres" and DATABASE_URL:
+        return PostgresStateStore()
+    if STATE_BACKEND != "memory":
+        log.warning(f"⚠️ STATE_BACKEND={STATE_BACKEND} недоступен, лимиты только в памяти")
+    if REPLICA_COUNT > 1 and HISTORY_BACKEND == "memory":
+        log.warning("⚠️ Несколько реплик, а история в памяти: при смене числа реплик диалоги потеряются")
+    return MemoryStateStore()
+
+
+state_store: StateStore = MemoryStateStore()
+
+
+# ──────────────────────────────────────────
+# РАЗДЕЛЕНИЕ АПДЕЙТОВ МЕЖДУ РЕПЛИКАМИ
+# ──────────────────────────────────────────
+# Владелец чата — chat_id % REPLICA_COUNT: все апдейты одного пользователя обрабатывает
+# одна реплика, так что склейка сообщений, кэш истории и очередь ответов остаются локальными.
+replica_client: httpx.AsyncClient | None = None
+replica_stats = {"forwarded": 0, "forward_errors": 0}
+
+MetricCallback("bot_replica_forwarded_total", "Апдейты, пересланные реплике-владельцу", "counter", lambda: {
+    (("result", "ok"),): replica_stats["forwarded"],
+    (("result", "error"),): replica_stats["forward_errors"],
+})
+
+
+def update_owner(update: Update) -> int:
+    chat = update.effective_chat or update.effective_user
+    return chat.id % REPLICA_COUNT if chat else REPLICA_ID
+
+
+async def forward_update(data: dict, owner: int) -> int | None:
+    """Передаёт апдейт владельцу; возвращает HTTP-статус или None, если реплика недоступна"""
+    global replica_client
+    if replica_client is None:
+        replica_client = httpx.AsyncClient(timeout=REPLICA_FORWARD_TIMEOUT)
+    try:
+        response = await replica_client.post(REPLICA_URLS[owner], json=data, headers={
+            "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET,
+            "X-Sokrat-Forwarded-By": str(REPLICA_ID),
+        })
+    except httpx.HTTPError as error:
+        replica_stats["forward_errors"] += 1
+        log.warning(f"⚠️ Реплика {owner} недоступна ({type(error).__name__}), обрабатываю сам")
+        return None
+    if response.status_code == 200:
+        replica_stats["forwarded"] += 1
+    else:
+        replica_stats["forward_errors"] += 1
+    return response.status_code
+
+
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группа -1 в polling: чужие апдейты уходят владельцу и дальше здесь не обрабатываются"""
+    owner = update_owner(update)
+    if owner != REPLICA_ID and await forward_update(update.to_dict(), owner) == 200:
+        raise ApplicationHandlerStop
+
+
+async def close_replica_client():
+    global replica_client
+    if replica_client:
+        await replica_client.aclose()
+        replica_client = None
+
+# ──────────────────────────────────────────
+# КЭШ ОТВЕТОВ
+# ──────────────────────────────────────────
+answer_cache: OrderedDict[str, tuple[float, str]] = OrderedDict()  # ключ -> (время, ответ)
+answer_cache_stats = {"hits": 0, "misses": 0}
+
+MetricCallback("bot_answer_cache_total", "Обращения к кэшу ответов", "counter", lambda: {
+    (("result", "hit"),): answer_cache_stats["hits"],
+    (("result", "miss"),): answer_cache_stats["misses"],
+})
+
+_CODES_RE   = r"(ук|гк|тк|коап|нк|жк|ск|упк|гпк|апк)"
+_ARTICLE_RE = r"(?:ст|статья|статьи|статье|статью|статей)\.?"
+_CODE_ARTICLE = re.compile(rf"\b{_CODES_RE}(?:\s*рф)?\s*{_ARTICLE_RE}\s*(\d+(?:\.\d+)*)")
+_ARTICLE_CODE = re.compile(rf"\b{_ARTICLE_RE}\s*(\d+(?:\.\d+)*)(?:\s*{_CODES_RE}\b)?(?:\s*рф\b)?")
+
+
+def normalize_question(text: str) -> str:
+    """«Что будет за кражу, ст. 158 УК РФ?» -> «что будет за кражу ст 158 ук»"""
+    s = text.lower().replace("ё", "е")
+    s = _CODE_ARTICLE.sub(lambda m: f" ст {m.group(2)} {m.group(1)} ", s)
+    s = _ARTICLE_CODE.sub(lambda m: f" ст {m.group(1)} {m.group(2) or ''} ", s)
+    s = re.sub(r"[^\w\s.]", " ", s)
+    s = re.sub(r"(?<!\d)\.|\.(?!\d)", " ", s)  # точки оставляем только внутри «7.27»
+    return " ".join(s.split())
+
+
+def cache_get(question: str) -> str | None:
+    key = normalize_question(question)
+    item = answer_cache.get(key)
+    if item and time.monotonic() - item[0] < ANSWER_CACHE_TTL:
+        answer_cache.move_to_end(key)
+        answer_cache_stats["hits"] += 1
+        return item[1]
+    if item:
+        del answer_cache[key]
+    answer_cache_stats["misses"] += 1
+    return None
+
+
+def cache_put(question: str, answer: str):
+    key = normalize_question(question)
+    if not key or not answer:
+        return
+    answer_cache[key] = (time.monotonic(), answer)
+    answer_cache.move_to_end(key)
+    while len(answer_cache) > ANSWER_CACHE_SIZE:
+        answer_cache.popitem(last=False)
+
+
+async def warm_answer_cache():
+    """Прогревает кэш ответами, которые пользователи оценили на 👍"""
+    if not db_pool or ANSWER_CACHE_WARM <= 0:
+        return
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT question, answer FROM questions WHERE rating=5 ORDER BY id DESC LIMIT $1",
+            ANSWER_CACHE_WARM
+        )
+    for r in reversed(rows):  # самые свежие — в конец LRU
+        cache_put(r["question"], r["answer"])
+    log.info(f"✅ Кэш ответов прогрет: {len(answer_cache)}")
+
+# ──────────────────────────────────────────
+# КОДЕКСЫ (локальный индекс)
+# ──────────────────────────────────────────
+# Тексты кодексов лежат в CODEX_DIR (uk.txt, gk.txt, ...), статьи начинаются со строки
+# «Статья 158. Кража». Индекс собирается один раз в CODEX_INDEX_DIR и дальше читается через mmap:
+#   articles.bin — тексты статей подряд (UTF-8)
+#   postings.bin — пары uint32 (номер статьи, частота терма)
+#   meta.json    — статьи, словарь термов -> (смещение в postings, df) и отпечаток исходников
+CODEX_NAMES = {
+    "uk":    "УК РФ",
+    "gk":    "ГК РФ",
+    "tk":    "ТК РФ",
+    "koap":  "КоАП РФ",
+    "konst": "Конституция РФ",
+}
+_CODEX_ALIASES = {"ук": "uk", "гк": "gk", "тк": "tk", "коап": "koap"}
+_ARTICLE_HEADER = re.compile(r"^\s*Статья\s+(\d+(?:\.\d+)*)\.?\s*(.*)$", re.M)
+_LOOKUP_NOISE = {"рф", "текст", "покажи", "найди", "статья", "кодекс", "кодекса", "конституция", "конституции"}
+_STOPWORDS = set(
+    "и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было "
+    "вот от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас нибудь "
+    "опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам "
+    "чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой совсем ним здесь "
+    "этом один почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при наконец два об другой "
+    "хоть после над больше тот через эти нас про всего них какая много разве три эту моя впрочем хорошо "
+    "свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно всю между".split()
+)
+
+# Стеммер Портера для русского (Snowball), без внешних зависимостей
+_RU_VOWELS = "аеиоуыэюя"
+_PERFECTIVE_GERUND = (("в", "вши", "вшись"), ("ив", "ивши", "ившись", "ыв", "ывши", "ывшись"))
+_REFLEXIVE = ((), ("ся", "сь"))
+_ADJECTIVE = ((), (
+    "ее", "ие", "ые", "ое", "ими", "ыми", "ей", "ий", "ый", "ой", "ем", "им", "ым", "ом",
+    "его", "ого", "ему", "ому", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею",
+))
+_PARTICIPLE = (("ем", "нн", "вш", "ющ", "щ"), ("ивш", "ывш", "ующ"))
+_VERB = (
+    ("ла", "на", "ете", "йте", "ли", "й", "л", "ем", "н", "ло", "но", "ет", "ют", "ны", "ть", "ешь", "нно"),
+    ("ила", "ыла", "ена", "ейте", "уйте", "ите", "или", "ыли", "ей", "уй", "ил", "ыл", "им", "ым", "ен",
+     "ило", "ыло", "ено", "ят", "ует", "уют", "ит", "ыт", "ены", "ить", "ыть", "ишь", "ую", "ю"),
+)
+_NOUN = ((), (
+    "а", "ев", "ов", "ие", "ье", "е", "иями", "ями", "ами", "еи", "ии", "и", "ией", "ей", "ой", "ий", "й",
+    "иям", "ям", "ием", "ем", "ам", "ом", "о", "у", "ах", "иях", "ях", "ы", "ь", "ию", "ью", "ю", "ия", "ья", "я",
+))
+
+
+def _strip_ending(rv: str, groups: tuple) -> str | None:
+    """Срезает самое длинное окончание; окончания первой группы — только после «а»/«я»"""
+    after_a, plain = groups
+    for ending in sorted(after_a + plain, key=len, reverse=True):
+        if not rv.endswith(ending):
+            continue
+        rest = rv[:-len(ending)]
+        if ending in after_a and ending not in plain and not rest.endswith(("а", "я")):
+            continue
+        return rest
+    return None
+
+
+def _ru_region(word: str, start: int) -> int:
+    """Начало R1/R2: позиция после первой согласной, идущей за гласной"""
+    for i in range(max(start, 1), len(word)):
+        if word[i] not in _RU_VOWELS and word[i - 1] in _RU_VOWELS:
+            return i + 1
+    return len(word)
+
+
+@lru_cache(maxsize=100000)
+def stem_ru(word: str) -> str:
+    word = word.lower().replace("ё", "е")
+    first_vowel = next((i for i, ch in enumerate(word) if ch in _RU_VOWELS), None)
+    if first_vowel is None:
+        return word
+    head, rv = word[:first_vowel + 1], word[first_vowel + 1:]
+    r2 = _ru_region(word, _ru_region(word, 1) + 1)
+
+    # Шаг 1
+    rest = _strip_ending(rv, _PERFECTIVE_GERUND)
+    if rest is None:
+        reflexive = _strip_ending(rv, _REFLEXIVE)
+        rv = rv if reflexive is None else reflexive
+        rest = _strip_ending(rv, _ADJECTIVE)
+        if rest is not None:
+            participle = _strip_ending(rest, _PARTICIPLE)
+            rest = rest if participle is None else participle
+        else:
+            rest = _strip_ending(rv, _VERB)
+            if rest is None:
+                rest = _strip_ending(rv, _NOUN)
+    rv = rv if rest is None else rest
+
+    # Шаг 2
+    if rv.endswith("и"):
+        rv = rv[:-1]
+    # Шаг 3: словообразовательные окончания в R2
+    for ending in ("ость", "ост"):
+        if rv.endswith(ending) and len(head) + len(rv) - len(ending) >= r2:
+            rv = rv[:-len(ending)]
+            break
+    # Шаг 4
+    if rv.endswith("ь"):
+        rv = rv[:-1]
+    else:
+        for ending in ("ейше", "ейш"):
+            if rv.endswith(ending):
+                rv = rv[:-len(ending)]
+                break
+        if rv.endswith("нн"):
+            rv = rv[:-1]
+    return head + rv
+
+
+def codex_terms(text: str) -> list[str]:
+    return [
+        stem_ru(w) for w in re.findall(r"[а-яёa-z0-9]+", text.lower())
+        if len(w) > 1 and w not in _STOPWORDS
+    ]
+
+
+def codex_fingerprint(src_dir: str) -> str:
+    parts = []
+    for key in CODEX_NAMES:
+        path = os.path.join(src_dir, f"{key}.txt")
+        if os.path.exists(path):
+            st = os.stat(path)
+            parts.append(f"{key}:{st.st_size}:{int(st.st_mtime)}")
+    return "|".join(parts)
+
+
+def build_codex_index(src_dir: str, index_dir: str):
+    """Разбирает кодексы на статьи и пишет индекс на диск (вызывается, если исходники поменялись)"""
+    import array
+
+    articles, texts, postings = [], [], defaultdict(list)
+    offset = 0
+    for key in CODEX_NAMES:
+        path = os.path.join(src_dir, f"{key}.txt")
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            source = f.read()
+        headers = list(_ARTICLE_HEADER.finditer(source))
+        for i, m in enumerate(headers):
+            end = headers[i + 1].start() if i + 1 < len(headers) else len(source)
+            body = source[m.start():end].strip().encode("utf-8")
+            terms = codex_terms(f"{m.group(2)} {source[m.end():end]}")
+            doc_id = len(articles)
+            for term, tf in Counter(terms).items():
+                postings[term].append((doc_id, tf))
+            articles.append([key, m.group(1), m.group(2).strip(), offset, len(body), len(terms)])
+            texts.append(body)
+            offset += len(body)
+
+    os.makedirs(index_dir, exist_ok=True)
+    flat, term_table = array.array("I"), {}
+    for term, plist in postings.items():
+        term_table[term] = [len(flat) // 2, len(plist)]
+        for doc_id, tf in plist:
+            flat.extend((doc_id, tf))
+    with open(os.path.join(index_dir, "articles.bin"), "wb") as f:
+        f.write(b"".join(texts))
+    with open(os.path.join(index_dir, "postings.bin"), "wb") as f:
+        flat.tofile(f)
+    avgdl = sum(a[5] for a in articles) / len(articles) if articles else 0
+    with open(os.path.join(index_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "fingerprint": codex_fingerprint(src_dir),
+            "articles": articles,
+            "avgdl": avgdl,
+            "terms": term_table,
+        }, f, ensure_ascii=False)
+
+
+class CodexIndex:
+    """Поиск по кодексам: точный номер статьи за O(1) и BM25 по стеммированным словам"""
+
+    K1 = 1.2
+    B  = 0.75
+
+    def __init__(self, index_dir: str):
+        import mmap
+        with open(os.path.join(index_dir, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.articles = meta["articles"]
+        self.terms    = meta["terms"]
+        self.avgdl    = meta["avgdl"] or 1
+        self.by_number = {f"{a[0]}:{a[1]}": i for i, a in enumerate(self.articles)}
+        self._files = []
+        self.text_map = self._mmap(os.path.join(index_dir, "articles.bin"), mmap)
+        postings      = self._mmap(os.path.join(index_dir, "postings.bin"), mmap)
+        self.postings = memoryview(postings).cast("I") if postings else memoryview(b"").cast("I")
+
+    def _mmap(self, path: str, mmap):
+        if os.path.getsize(path) == 0:
+            return b""
+        f = open(path, "rb")
+        self._files.append(f)
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.articles)
+
+    def text(self, doc_id: int) -> str:
+        offset, length = self.articles[doc_id][3], self.articles[doc_id][4]
+        return bytes(self.text_map[offset:offset + length]).decode("utf-8")
+
+    def title(self, doc_id: int) -> str:
+        key, number, title = self.articles[doc_id][:3]
+        return f"{CODEX_NAMES[key]}, статья {number}. {title}".rstrip(". ")
+
+    def lookup(self, question: str) -> tuple[int | None, bool]:
+        """(номер статьи, «в вопросе нет ничего, кроме ссылки на статью»)"""
+        norm = normalize_question(question)
+        m = re.search(r"\bст (\d+(?:\.\d+)*)(?: (ук|гк|тк|коап)\b)?", norm)
+        if not m:
+            return None, False
+        key = _CODEX_ALIASES.get(m.group(2)) or ("konst" if "конституц" in norm else None)
+        doc_id = self.by_number.get(f"{key}:{m.group(1)}") if key else None
+        rest = [w for w in (norm[:m.start()] + norm[m.end():]).split() if w not in _LOOKUP_NOISE]
+        return doc_id, doc_id is not None and len(rest) <= 1
+
+    def search(self, query: str, k: int) -> list[tuple[int, float]]:
+        n = len(self.articles)
+        scores: dict[int, float] = defaultdict(float)
+        for term in set(codex_terms(query)):
+            entry = self.terms.get(term)
+            if not entry:
+                continue
+            start, df = entry
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for i in range(start, start + df):
+                doc_id, tf = self.postings[2 * i], self.postings[2 * i + 1]
+                dl = self.articles[doc_id][5]
+                scores[doc_id] += idf * tf * (self.K1 + 1) / (tf + self.K1 * (1 - self.B + self.B * dl / self.avgdl))
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+codex_index: CodexIndex | None = None
+codex_stats = {"lookups": 0, "rag": 0}
+
+
+def load_codex_index():
+    """Пересобирает индекс, если тексты кодексов изменились, и открывает его через mmap"""
+    global codex_index
+    meta_path = os.path.join(CODEX_INDEX_DIR, "meta.json")
+    fingerprint = codex_fingerprint(CODEX_DIR)
+    if not fingerprint:
+        log.warning(f"⚠️ Кодексы не найдены в {CODEX_DIR}, поиск по статьям идёт через Mistral")
+        return
+    try:
+        stale = True
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                stale = json.load(f).get("fingerprint") != fingerprint
+        if stale:
+            build_codex_index(CODEX_DIR, CODEX_INDEX_DIR)
+        codex_index = CodexIndex(CODEX_INDEX_DIR)
+    except (OSError, ValueError) as error:
+        # Например, CODEX_INDEX_DIR на read-only томе — бот должен стартовать и без индекса
+        log.warning(f"⚠️ Индекс кодексов недоступен ({error}), поиск по статьям идёт через Mistral")
+        return
+    log.info(f"✅ Индекс кодексов: {len(codex_index)} статей")
+
+
+def codex_article_reply(doc_id: int) -> str:
+    return f"📜 {codex_index.title(doc_id)}\n\n{codex_index.text(doc_id)}"[:4000]
+
+
+def with_codex_context(question: str) -> str:
+    """Добавляет к вопросу выдержки из самых подходящих статей"""
+    if not codex_index:
+        return question
+    doc_id, _ = codex_index.lookup(question)
+    hits = [doc_id] if doc_id is not None else []
+    hits += [d for d, _ in codex_index.search(question, CODEX_TOP_K) if d not in hits]
+    if not hits:
+        return question
+    codex_stats["rag"] += 1
+    snippets = "\n\n".join(
+        f"[{codex_index.title(d)}]\n{codex_index.text(d)[:CODEX_SNIPPET_CHARS]}" for d in hits[:CODEX_TOP_K]
+    )
+    return f"{question}\n\nВыдержки из кодексов (опирайся на них, если они в тему):\n{snippets}"
 
-RATE_LIMIT_SECONDS = 3
-MAX_HISTORY        = 10
 
 # ──────────────────────────────────────────
 # AI — Mistral
 # ──────────────────────────────────────────
-async def get_ai_response(messages: list[dict]) -> str:
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            "https://api.mistral.ai/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {MISTRAL_API_KEY}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": "mistral-small-latest",
-                "messages": [
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    *messages
-                ],
-                "max_tokens": 350,
-                "temperature": 0.7
-            }
+http_client: httpx.AsyncClient | None = None
+
+# Метрики запросов к Mistral: последние задержки (сек) и счётчики
+llm_latencies: deque = deque(maxlen=500)
+llm_first_token: deque = deque(maxlen=500)  # время до первого токена в стриме
+llm_stats = {"requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+llm_errors: dict[str, int] = defaultdict(int)  # "429", "503", "ReadTimeout", ...
+context_stats = {"dropped_messages": 0, "truncated_messages": 0}
+
+
+async def init_http():
+    """Создаёт общий HTTP/2-клиент с keep-alive — TLS-рукопожатие делается один раз"""
+    global http_client
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            HTTP_READ_TIMEOUT,
+            connect=HTTP_CONNECT_TIMEOUT,
+            read=HTTP_READ_TIMEOUT,
+        ),
+        headers={
+            "Authorization": f"Bearer {MISTRAL_API_KEY}",
+            "Content-Type": "application/json"
+        },
+    )
+    if HTTP_PREWARM:
+        # Любой ответ подходит: важно, что соединение (DNS, TLS, HTTP/2) осталось в пуле
+        try:
+            await http_client.get(MISTRAL_URL.rsplit("/chat/completions", 1)[0] + "/models")
+        except httpx.HTTPError as error:
+            log.warning(f"⚠️ Не удалось прогреть соединение с Mistral: {error}")
+    log.info("✅ HTTP-клиент Mistral готов")
+
+
+async def close_http():
+    global http_client
+    if http_client:
+        await http_client.aclose()
+        http_client = None
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    data = sorted(values)
+    k = min(len(data) - 1, max(0, round(p / 100 * (len(data) - 1))))
+    return data[k]
+
+
+def llm_latency_summary() -> str:
+    lat = list(llm_latencies)
+    summary = (
+        f"{llm_stats['requests']} запр., {llm_stats['errors']} ошиб., "
+        f"p50 {percentile(lat, 50) * 1000:.0f} мс, p95 {percentile(lat, 95) * 1000:.0f} мс"
+    )
+    if llm_first_token:
+        summary += f", первый токен p50 {percentile(list(llm_first_token), 50) * 1000:.0f} мс"
+    summary += (
+        f"\n🔢 Токены: вход {llm_stats['prompt_tokens']}, выход {llm_stats['completion_tokens']}, "
+        f"отброшено сообщений истории {context_stats['dropped_messages']}, "
+        f"обрезано длинных {context_stats['truncated_messages']}"
+    )
+    if llm_errors:
+        summary += "\n🚨 Ошибки: " + ", ".join(f"{k}: {v}" for k, v in sorted(llm_errors.items()))
+    return summary
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка токенов сообщения (+4 на служебную разметку). Без кэша: len() и так O(1),
+    а кэш держал бы живыми тексты, уже вытесненные из истории"""
+    return int(len(text) / CHARS_PER_TOKEN) + 4
+
+
+def fit_to_budget(text: str, budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """Обрезает текст так, чтобы вместе с системным промптом он влез в budget токенов"""
+    limit = int((budget - estimate_tokens(SYSTEM_PROMPT) - 4) * CHARS_PER_TOKEN)
+    if len(text) <= limit:
+        return text
+    context_stats["truncated_messages"] += 1
+    return text[:max(limit - 1, 0)] + "…"
+
+
+def build_context(messages: list[dict], budget: int = CONTEXT_TOKEN_BUDGET) -> list[dict]:
+    """Берёт сообщения с конца, пока влезают в бюджет. Последнее сообщение уходит всегда —
+    если оно само больше бюджета, то обрезанным (запрос сверх контекста модели всё равно упадёт),
+    а контекст начинается с реплики пользователя."""
+    full_budget = budget
+    budget -= estimate_tokens(SYSTEM_PROMPT)
+    picked = []
+    for message in reversed(messages):
+        cost = estimate_tokens(message["content"])
+        if not picked and cost > budget:
+            message = {**message, "content": fit_to_budget(message["content"], full_budget)}
+            cost = estimate_tokens(message["content"])
+        if picked and cost > budget:
+            break
+        picked.append(message)
+        budget -= cost
+    while len(picked) > 1 and picked[-1]["role"] != "user":
+        picked.pop()
+    context_stats["dropped_messages"] += len(messages) - len(picked)
+    return picked[::-1]
+
+
+def record_usage(usage: dict | None, data: dict | None, started: float):
+    """Копирует usage из ответа API в словарь вызывающего и в общие счётчики"""
+    api_usage = (data or {}).get("usage") or {}
+    llm_stats["prompt_tokens"]     += api_usage.get("prompt_tokens", 0)
+    llm_stats["completion_tokens"] += api_usage.get("completion_tokens", 0)
+    if usage is not None:
+        usage["prompt_tokens"]     = api_usage.get("prompt_tokens")
+        usage["completion_tokens"] = api_usage.get("completion_tokens")
+        usage["latency_ms"]        = int((time.perf_counter() - started) * 1000)
+
+
+def add_usage(total: dict, usage: dict):
+    """Складывает токены одного запроса в общий счёт задачи (документ — это много запросов)"""
+    for key in ("prompt_tokens", "completion_tokens"):
+        if usage.get(key) is not None:
+            total[key] = (total.get(key) or 0) + usage[key]
+
+
+def mistral_payload(messages: list[dict], stream: bool = False) -> dict:
+    return {
+        "model": "mistral-small-latest",
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            *build_context(messages)
+        ],
+        "max_tokens": 350,
+        "temperature": 0.7,
+        "stream": stream
+    }
+
+
+# ──────────────────────────────────────────
+# ПЛАНИРОВЩИК LLM
+# ──────────────────────────────────────────
+PRIORITY_CHAT = 0
+PRIORITY_DOC  = 1  # анализ документов ждёт, пока есть вопросы в чате
+
+
+class LLMUnavailable(Exception):
+    """Mistral лежит — circuit breaker открыт, запрос даже не отправляем"""
+
+
+class LLMBusy(LLMUnavailable):
+    """Очередь к Mistral полна — лучше сразу сказать «попробуй позже», чем копить ожидающих"""
+
+
+def error_kind(error: Exception) -> str:
+    if isinstance(error, httpx.HTTPStatusError):
+        return str(error.response.status_code)
+    return type(error).__name__
+
+
+class LLMScheduler:
+    """Не больше max_in_flight запросов к Mistral одновременно.
+    Очередь честная: внутри класса приоритета пользователи обслуживаются по кругу,
+    и ограничена max_queue — это и есть граница приёма для хендлеров, ушедших из слотов PTB.
+    Ретраи с экспоненциальной задержкой и jitter, Retry-After уважаем.
+    После LLM_BREAKER_THRESHOLD сбоев подряд breaker открывается на LLM_BREAKER_COOLDOWN,
+    потом пропускает один пробный запрос."""
+
+    def __init__(self, max_in_flight: int, max_queue: int):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.queues: list[OrderedDict[int, deque]] = [OrderedDict(), OrderedDict()]  # по приоритетам
+        self.waits: deque = deque(maxlen=500)
+        self.failures  = 0
+        self.opened_at: float | None = None
+        self.trial     = False
+        self.stats = {"retries": 0, "rejected": 0, "busy": 0}
+
+    def depth(self) -> int:
+        return sum(len(waiters) for queue in self.queues for waiters in queue.values())
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id: int, priority: int = PRIORITY_CHAT):
+        started = time.monotonic()
+        if self.in_flight < self.max_in_flight and not self.depth():
+            self.in_flight += 1
+        else:
+            if self.depth() >= self.max_queue:
+                self.stats["busy"] += 1
+                raise LLMBusy()
+            future = asyncio.get_running_loop().create_future()
+            self.queues[priority].setdefault(user_id, deque()).append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release()  # слот уже выдали, а нас отменили
+                else:
+                    self._forget(priority, user_id, future)
+                raise
+        self.waits.append(time.monotonic() - started)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _forget(self, priority: int, user_id: int, future: asyncio.Future):
+        waiters = self.queues[priority].get(user_id)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self.queues[priority][user_id]
+
+    def _release(self):
+        self.in_flight -= 1
+        while self.in_flight < self.max_in_flight:
+            future = self._next_waiter()
+            if future is None:
+                return
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def _next_waiter(self) -> asyncio.Future | None:
+        for queue in self.queues:
+            if queue:
+                user_id, waiters = next(iter(queue.items()))
+                future = waiters.popleft()
+                if waiters:
+                    queue.move_to_end(user_id)  # следующий пользователь, потом снова этот
+                else:
+                    del queue[user_id]
+                return future
+        return None
+
+    def check_breaker(self) -> bool:
+        """True — этот запрос пробный"""
+        if self.opened_at is None:
+            return False
+        if self.trial or time.monotonic() - self.opened_at < LLM_BREAKER_COOLDOWN:
+            self.stats["rejected"] += 1
+            raise LLMUnavailable()
+        self.trial = True  # полуоткрыт: пропускаем один пробный запрос
+        return True
+
+    @contextlib.contextmanager
+    def breaker(self):
+        """Одна попытка запроса. Пробный запрос, не дошедший до record_success
+        (4xx, 429, отмена, битый JSON — что угодно), снова открывает breaker"""
+        probe = self.check_breaker()
+        try:
+            yield
+        except LLMBusy:
+            if probe and self.trial:
+                self.trial = False  # проба так и не ушла — следующий запрос попробует снова
+            raise
+        finally:
+            if probe and self.trial:
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+    def record_success(self):
+        self.failures  = 0
+        self.opened_at = None
+        self.trial     = False
+
+    def retry_delay(self, error: Exception, attempt: int) -> float | None:
+        """Учитывает ошибку в breaker и возвращает паузу перед ретраем (None — не ретраим)"""
+        status = error.response.status_code if isinstance(error, httpx.HTTPStatusError) else None
+        if status is None or status == 429 or status >= 500:
+            self.failures += 1
+            if self.trial or self.failures >= LLM_BREAKER_THRESHOLD:
+                self.opened_at = time.monotonic()
+                self.trial = False
+        if status is not None and status != 429 and status < 500:
+            return None
+        if attempt >= LLM_MAX_RETRIES or self.opened_at is not None:
+            return None
+        delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+        if status is not None:
+            try:
+                retry_after = float(error.response.headers.get("Retry-After", 0))
+            except ValueError:
+                retry_after = 0
+            if retry_after > LLM_BACKOFF_MAX:
+                return None
+            delay = max(delay, retry_after)
+        self.stats["retries"] += 1
+        return delay
+
+    def stats_text(self) -> str:
+        waits = list(self.waits)
+        if self.opened_at is None:
+            breaker = "закрыт"
+        else:
+            breaker = "пробный запрос" if self.trial else "ОТКРЫТ"
+        return (
+            f"в работе {self.in_flight}/{self.max_in_flight}, в очереди {self.depth()}, "
+            f"ожидание p50 {percentile(waits, 50) * 1000:.0f} мс, p95 {percentile(waits, 95) * 1000:.0f} мс, "
+            f"ретраев {self.stats['retries']}, отказов {self.stats['rejected']}, "
+            f"очередь полна {self.stats['busy']}, breaker {breaker}"
         )
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
+
+
+llm_scheduler = LLMScheduler(LLM_MAX_IN_FLIGHT, LLM_QUEUE_MAX)
+
+MetricCallback("bot_llm_in_flight", "Запросы к Mistral в работе", "gauge", lambda: llm_scheduler.in_flight)
+MetricCallback("bot_llm_queue_depth", "Запросы к Mistral в очереди", "gauge", llm_scheduler.depth)
+MetricCallback("bot_llm_requests_total", "Запросы к Mistral", "counter", lambda: llm_stats["requests"])
+MetricCallback("bot_llm_tokens_total", "Токены Mistral", "counter", lambda: {
+    (("kind", "prompt"),): llm_stats["prompt_tokens"],
+    (("kind", "completion"),): llm_stats["completion_tokens"],
+})
+MetricCallback("bot_llm_errors_total", "Ошибки Mistral по типам", "counter",
+               lambda: {(("type", k),): v for k, v in llm_errors.items()})
+
+
+async def get_ai_response(messages: list[dict], usage: dict | None = None,
+                          user_id: int = 0, priority: int = PRIORITY_CHAT) -> str:
+    """usage (если передан) заполняется токенами и задержкой запроса"""
+    if http_client is None:
+        await init_http()
+    started = time.perf_counter()
+    payload = mistral_payload(messages)
+    llm_stats["requests"] += 1
+    try:
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                with llm_scheduler.breaker():
+                    async with llm_scheduler.slot(user_id, priority):
+                        response = await http_client.post(MISTRAL_URL, json=payload)
+                        response.raise_for_status()
+                    llm_scheduler.record_success()
+            except (httpx.HTTPStatusError, httpx.TransportError) as error:
+                delay = llm_scheduler.retry_delay(error, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            data = response.json()
+            record_usage(usage, data, started)
+            return data["choices"][0]["message"]["content"]
+    except Exception as error:
+        llm_stats["errors"] += 1
+        llm_errors[error_kind(error)] += 1
+        raise
+    finally:
+        llm_latencies.append(time.perf_counter() - started)
+
+
+async def stream_ai_response(messages: list[dict], usage: dict | None = None,
+                             user_id: int = 0, priority: int = PRIORITY_CHAT):
+    """Читает SSE-поток Mistral (stream: true) и отдаёт куски текста по мере генерации.
+    Ретраим, только пока пользователь ещё ничего не увидел."""
+    if http_client is None:
+        await init_http()
+    started = time.perf_counter()
+    payload = mistral_payload(messages, stream=True)
+    first = True
+    llm_stats["requests"] += 1
+    try:
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                with llm_scheduler.breaker():
+                    async with llm_scheduler.slot(user_id, priority):
+                        async with http_client.stream("POST", MISTRAL_URL, json=payload) as response:
+                            if response.is_error:
+                                await response.aread()  # чтобы e.response.text был доступен в обработчике
+                            response.raise_for_status()
+                            llm_scheduler.record_success()
+                            async for line in response.aiter_lines():
+                                if not line.startswith("data:"):
+                                    continue
+                                data = line[5:].strip()
+                                if data == "[DONE]":
+                                    break
+                                chunk = json.loads(data)
+                                if chunk.get("usage"):  # приходит в последнем чанке
+                                    record_usage(usage, chunk, started)
+                                choices = chunk.get("choices") or [{}]
+                                delta = choices[0].get("delta", {}).get("content")
+                                if not delta:
+                                    continue
+                                if first:
+                                    llm_first_token.append(time.perf_counter() - started)
+                                    first = False
+                                yield delta
+                    return
+            except (httpx.HTTPStatusError, httpx.TransportError) as error:
+                delay = llm_scheduler.retry_delay(error, attempt)
+                if delay is None or not first:
+                    raise
+                await asyncio.sleep(delay)
+    except Exception as error:
+        llm_stats["errors"] += 1
+        llm_errors[error_kind(error)] += 1
+        raise
+    finally:
+        llm_latencies.append(time.perf_counter() - started)
 
 
 # ──────────────────────────────────────────
 # УТИЛИТЫ
 # ──────────────────────────────────────────
-def rate_limit_check(user_id: int) -> bool:
-    now = time.time()
-    if now - user_last_request[user_id] < RATE_LIMIT_SECONDS:
-        return False
-    user_last_request[user_id] = now
-    return True
+async def rate_limit_check(user_id: int) -> bool:
+    return await state_store.hit(user_id)
 
 
 def is_admin(user_id: int) -> bool:
@@ -207,24 +2436,502 @@ def main_keyboard() -> InlineKeyboardMarkup:
     ])
 
 
-def rating_keyboard(question_id: int) -> InlineKeyboardMarkup:
+def rating_keyboard(question_id: int) -> InlineKeyboardMarkup | None:
+    if not question_id:
+        return None  # вопрос не сохранён — оценивать нечего
     return InlineKeyboardMarkup([[
         InlineKeyboardButton("👍", callback_data=f"rate_5_{question_id}"),
         InlineKeyboardButton("👎", callback_data=f"rate_1_{question_id}"),
     ]])
 
 
-def read_document_text(path: str, filename: str) -> str:
+def retry_after_seconds(error: RetryAfter) -> float:
+    delay = error.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+
+async def stream_to_message(msg, messages: list[dict], prefix: str = "", usage: dict | None = None,
+                            user_id: int = 0, priority: int = PRIORITY_CHAT) -> str:
+    """Стримит ответ в сообщение msg, правя его не чаще STREAM_EDIT_INTERVAL.
+    Возвращает полный текст; финальную правку (с клавиатурой) делает вызывающий."""
+    text, shown = "", ""
+    next_edit = time.monotonic()
+    async for delta in stream_ai_response(messages, usage, user_id, priority):
+        text += delta
+        now = time.monotonic()
+        if now < next_edit or text == shown or not text.strip():
+            continue
+        next_edit = now + STREAM_EDIT_INTERVAL
+        try:
+            with stage("telegram"):
+                await msg.edit_text((prefix + text)[:4090] + " ▌")
+            shown = text
+        except RetryAfter as e:
+            next_edit = now + retry_after_seconds(e)
+        except BadRequest:
+            pass
+    return text
+
+
+def read_document_text(data: bytes, filename: str, limit: int = DOC_CHAR_LIMIT) -> str:
+    """Достаёт текст из файла в памяти; страницы PDF читаются, пока не наберётся limit символов"""
     if filename.lower().endswith(".pdf"):
         try:
             import pypdf
-            reader = pypdf.PdfReader(path)
-            return " ".join(p.extract_text() or "" for p in reader.pages)[:4000]
         except ImportError:
             return "[PDF: установи pypdf]"
-    else:
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            return f.read()[:4000]
+        reader = pypdf.PdfReader(io.BytesIO(data))
+        parts, size = [], 0
+        for page in reader.pages:
+            text = page.extract_text() or ""
+            parts.append(text)
+            size += len(text) + 1
+            if size >= limit:
+                break
+        return " ".join(parts)[:limit]
+    return data[:limit * 4].decode("utf-8", errors="ignore")[:limit]
+
+
+# ──────────────────────────────────────────
+# ПУЛ ПРОЦЕССОВ ДЛЯ PDF
+# ──────────────────────────────────────────
+doc_pool: ProcessPoolExecutor | None = None
+# Документы ждут здесь, а не в очереди пула: таймаут меряет только разбор, а не очередь за зависшим соседом
+doc_slots = asyncio.Semaphore(DOC_WORKERS)
+
+
+def _doc_worker_init():
+    """Ограничивает память воркера — битый PDF упадёт с MemoryError, а не съест контейнер"""
+    try:
+        import resource
+        cap = DOC_WORKER_MEMORY_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (cap, cap))
+    except (ImportError, ValueError, OSError):
+        pass
+    try:
+        import pypdf  # noqa: F401 — грузим сразу, а не на первом документе
+    except ImportError:
+        pass
+
+
+def _doc_worker_ping() -> int:
+    return os.getpid()
+
+
+async def prewarm_documents():
+    """Поднимает воркеры разбора PDF (и импорт pypdf в них) в фоне, чтобы первый документ их не ждал"""
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    pool = get_doc_pool()
+    try:
+        await asyncio.gather(*(loop.run_in_executor(pool, _doc_worker_ping) for _ in range(DOC_WORKERS)))
+    except BrokenProcessPool:
+        if doc_pool is pool:
+            reset_doc_pool()
+        return
+    startup_timings.append(("prewarm documents", time.perf_counter() - started))
+    if STARTUP_PROFILE:
+        log.info(f"⏱️ prewarm documents: {(time.perf_counter() - started) * 1000:.0f} мс (в фоне)")
+
+
+def get_doc_pool() -> ProcessPoolExecutor:
+    global doc_pool
+    if doc_pool is None:
+        doc_pool = ProcessPoolExecutor(max_workers=DOC_WORKERS, initializer=_doc_worker_init)
+    return doc_pool
+
+
+def reset_doc_pool():
+    """Убивает воркеры: зависший процесс иначе не остановить (задачи соседей тоже упадут)"""
+    global doc_pool
+    if doc_pool is None:
+        return
+    for process in list((getattr(doc_pool, "_processes", None) or {}).values()):
+        process.kill()
+    doc_pool.shutdown(wait=False, cancel_futures=True)
+    doc_pool = None
+
+
+async def extract_document_text(data: bytes, filename: str) -> str:
+    if not filename.lower().endswith(".pdf"):
+        return read_document_text(data, filename)
+    loop = asyncio.get_running_loop()
+    async with doc_slots:
+        for attempt in range(2):
+            pool = get_doc_pool()
+            future = loop.run_in_executor(pool, read_document_text, data, filename, DOC_CHAR_LIMIT)
+            try:
+                return await asyncio.wait_for(future, DOC_EXTRACT_TIMEOUT)
+            except asyncio.TimeoutError:
+                if doc_pool is pool:  # пул уже пересоздан — новый не трогаем
+                    reset_doc_pool()
+                raise
+            except BrokenProcessPool:
+                # Пул мог сломать чужой документ (таймаут или упавший воркер) — один повтор на новом пуле
+                if doc_pool is pool:
+                    reset_doc_pool()
+                if attempt:
+                    raise
+
+
+# ──────────────────────────────────────────
+# АНАЛИЗ ДОКУМЕНТОВ (map-reduce)
+# ──────────────────────────────────────────
+# Текст режется на куски по DOC_CHUNK_CHARS, каждый кусок разбирается отдельным запросом
+# (не больше DOC_MAP_CONCURRENCY на документ), заметки сводятся в один отчёт.
+# Готовый отчёт кэшируется по SHA-256 файла: тот же договор от другого пользователя отдаётся сразу.
+doc_cache: OrderedDict[str, tuple[float, str]] = OrderedDict()  # sha256 -> (время, отчёт)
+doc_cache_stats = {"hits": 0, "misses": 0}
+doc_inflight: dict[str, asyncio.Future] = {}  # этот файл уже разбирается — ждём его результат
+
+MetricCallback("bot_doc_cache_total", "Обращения к кэшу разборов документов", "counter", lambda: {
+    (("result", "hit"),): doc_cache_stats["hits"],
+    (("result", "miss"),): doc_cache_stats["misses"],
+})
+
+DOC_SINGLE_PROMPT = (
+    "Проанализируй этот документ как юрист:\n\n{text}\n\n"
+    "Найди: 1) Риски 2) Незаконные пункты 3) Рекомендации. Кратко, на русском."
+)
+DOC_MAP_PROMPT = (
+    "Это часть {i} из {n} документа. Проанализируй её как юрист и выпиши коротким списком: "
+    "риски, незаконные или спорные пункты (со ссылками на статьи), что стоит уточнить. "
+    "Если замечаний нет — ответь «Замечаний нет».\n\n{text}"
+)
+DOC_COMBINE_PROMPT = (
+    "Ниже заметки юриста по частям одного документа. Объедини их в один короткий список "
+    "без повторов, ничего важного не теряя.\n\n{text}"
+)
+DOC_REDUCE_PROMPT = (
+    "Ниже заметки юриста по частям одного документа. Сведи их в один отчёт без повторов: "
+    "1) Риски 2) Незаконные пункты 3) Рекомендации. Кратко, на русском.\n\n{text}"
+)
+
+
+def doc_cache_get(digest: str) -> str | None:
+    item = doc_cache.get(digest)
+    if item and time.monotonic() - item[0] < DOC_CACHE_TTL:
+        doc_cache.move_to_end(digest)
+        doc_cache_stats["hits"] += 1
+        return item[1]
+    if item:
+        del doc_cache[digest]
+    doc_cache_stats["misses"] += 1
+    return None
+
+
+def doc_cache_put(digest: str, report: str):
+    doc_cache[digest] = (time.monotonic(), report)
+    doc_cache.move_to_end(digest)
+    while len(doc_cache) > DOC_CACHE_SIZE:
+        doc_cache.popitem(last=False)
+
+
+def split_document(text: str, size: int = DOC_CHUNK_CHARS, overlap: int = DOC_CHUNK_OVERLAP) -> list[str]:
+    """Режет по границе абзаца или предложения во второй половине окна.
+    Соседние куски перекрываются на overlap символов, чтобы пункт на стыке не потерялся."""
+    text = text.strip()
+    chunks, start = [], 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            window = text[start + size // 2:end]
+            for sep in ("\n\n", "\n", ". "):
+                cut = window.rfind(sep)
+                if cut != -1:
+                    end = start + size // 2 + cut + len(sep)
+                    break
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return [c for c in chunks if c]
+
+
+def pack_notes(notes: list[str], size: int) -> list[str]:
+    """Склеивает заметки в пачки не длиннее size символов"""
+    batches, current = [], ""
+    for note in notes:
+        if current and len(current) + len(note) > size:
+            batches.append(current)
+            current = ""
+        current = f"{current}\n\n{note}" if current else note
+    return batches + [current] if current else batches
+
+
+class DocProgress:
+    """Статус разбора в одном сообщении: смена этапа — сразу, счётчики — не чаще STREAM_EDIT_INTERVAL"""
+
+    def __init__(self, msg: Message):
+        self.msg = msg
+        self.text = ""
+        self.next_edit = 0.0
+
+    async def update(self, text: str, force: bool = False):
+        now = time.monotonic()
+        if text == self.text or (not force and now < self.next_edit):
+            return
+        self.text, self.next_edit = text, now + STREAM_EDIT_INTERVAL
+        try:
+            with stage("telegram"):
+                await self.msg.edit_text(text)
+        except RetryAfter as e:
+            self.next_edit = now + retry_after_seconds(e)
+        except BadRequest:
+            pass
+
+
+async def gather_limited(coros: list, limit: int) -> list:
+    """asyncio.gather не больше limit одновременно; при ошибке остальные отменяются"""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    tasks = [asyncio.ensure_future(run(c)) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def analyze_document(text: str, progress: DocProgress, user_id: int, usage: dict | None = None) -> str:
+    """usage (если передан) копит токены всех запросов: частей, сведения и итогового отчёта"""
+    usage = {} if usage is None else usage
+
+    async def ask(template: str, body: str, **fields) -> str:
+        prompt = [{"role": "user", "content": template.format(text=body, **fields)}]
+        call = {}
+        try:
+            return await get_ai_response(prompt, call, user_id=user_id, priority=PRIORITY_DOC)
+        finally:
+            add_usage(usage, call)
+
+    async def final(template: str, body: str) -> str:
+        prompt = [{"role": "user", "content": template.format(text=body)}]
+        call = {}
+        try:
+            if STREAM_REPLIES:
+                return await stream_to_message(
+                    progress.msg, prompt, prefix="📋 Анализ:\n\n", usage=call,
+                    user_id=user_id, priority=PRIORITY_DOC
+                )
+            return await get_ai_response(prompt, call, user_id=user_id, priority=PRIORITY_DOC)
+        finally:
+            add_usage(usage, call)
+
+    chunks = split_document(text)
+    if len(chunks) <= 1:
+        await progress.update("🔍 Анализирую...", force=True)
+        return await final(DOC_SINGLE_PROMPT, text)
+
+    total, done = len(chunks), 0
+    await progress.update(f"📑 Частей: {total}\n🔍 Разобрано: 0/{total}", force=True)
+
+    async def map_chunk(i: int, chunk: str) -> str:
+        nonlocal done
+        notes = await ask(DOC_MAP_PROMPT, chunk, i=i, n=total)
+        done += 1
+        await progress.update(f"📑 Частей: {total}\n🔍 Разобрано: {done}/{total}", force=done == total)
+        return f"Часть {i}:\n{notes}"
+
+    notes = await gather_limited([map_chunk(i, c) for i, c in enumerate(chunks, 1)], DOC_MAP_CONCURRENCY)
+
+    # Заметок больше, чем влезет в один запрос, — сводим ступенями
+    while len(notes) > 1 and sum(len(n) for n in notes) > DOC_CHUNK_CHARS:
+        batches = pack_notes(notes, DOC_CHUNK_CHARS)
+        if len(batches) >= len(notes):
+            break
+        await progress.update(f"🧩 Свожу заметки: {len(notes)} → {len(batches)}", force=True)
+        notes = await gather_limited([ask(DOC_COMBINE_PROMPT, b) for b in batches], DOC_MAP_CONCURRENCY)
+
+    await progress.update("🧩 Свожу итоговый отчёт...", force=True)
+    return await final(DOC_REDUCE_PROMPT, "\n\n".join(notes))
+
+
+async def analyze_upload(data: bytes, filename: str, digest: str, progress: DocProgress, user_id: int) -> str | None:
+    """Текст + разбор + кэш. Параллельные загрузки того же файла ждут этот результат (None — не вышло)."""
+    future = asyncio.get_running_loop().create_future()
+    doc_inflight[digest] = future
+    report = None
+    started = time.perf_counter()
+    try:
+        with stage("extract"):
+            text = await extract_document_text(data, filename)
+        if not text.strip():
+            return None
+        note = ""
+        if len(text) >= DOC_CHAR_LIMIT:
+            note = f"⚠️ Документ длинный, разобрал первые {DOC_CHAR_LIMIT} символов.\n\n"
+        usage = {}
+        with stage("llm"):
+            report = note + await analyze_document(text, progress, user_id, usage)
+        doc_cache_put(digest, report)
+        # В questions — чтобы разбор документа попал в расход токенов пользователя
+        usage["latency_ms"] = int((time.perf_counter() - started) * 1000)
+        with stage("db"):
+            await save_question(user_id, f"📄 {filename or 'документ'}", report, usage)
+        return report
+    finally:
+        doc_inflight.pop(digest, None)
+        future.set_result(report)
+
+
+# ──────────────────────────────────────────
+# РАССЫЛКА
+# ──────────────────────────────────────────
+class TokenBucket:
+    """rate токенов в секунду с запасом capacity; pause() — для RetryAfter от Telegram"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+broadcast_tasks: set[asyncio.Task] = set()
+
+
+async def broadcast_send(bot, user_id: int, text: str) -> str:
+    """Отправляет одно сообщение рассылки: 'sent', 'blocked' или 'failed'"""
+    for _ in range(BROADCAST_RETRIES):
+        await broadcast_bucket.acquire()
+        try:
+            await bot.send_message(user_id, text)
+            return "sent"
+        except RetryAfter as e:
+            broadcast_bucket.pause(retry_after_seconds(e))
+        except Forbidden:
+            return "blocked"
+        except BadRequest as e:
+            return "blocked" if "chat not found" in str(e).lower() else "failed"
+        except Exception:
+            return "failed"
+    return "failed"
+
+
+def broadcast_status_text(b: dict, total: int) -> str:
+    done = b["sent"] + b["failed"] + b["blocked"]
+    head = "✅ Рассылка завершена" if b["status"] == "done" else f"📢 Рассылка: {done}/{total}"
+    return (
+        f"{head}\n\n"
+        f"✅ Отправлено: {b['sent']}\n"
+        f"🚫 Заблокировали бота: {b['blocked']}\n"
+        f"❌ Ошибок: {b['failed']}"
+    )
+
+
+async def edit_broadcast_status(bot, b: dict, total: int):
+    try:
+        await bot.edit_message_text(
+            broadcast_status_text(b, total),
+            chat_id=b["admin_chat_id"], message_id=b["status_message_id"]
+        )
+    except RetryAfter as e:
+        await asyncio.sleep(retry_after_seconds(e))
+    except BadRequest:
+        pass  # текст не изменился или сообщение удалено
+
+
+async def run_broadcast(bot, b: dict):
+    """Шлёт рассылку страницами по user_id. Курсор идёт по непрерывному префиксу отправленных
+    и пишется в БД по ходу страницы, так что после рестарта повторно уйдут только сообщения,
+    которые были в полёте (не больше BROADCAST_CONCURRENCY)"""
+    text   = f"📢 Сообщение от Сократа:\n\n{b['text']}"
+    total  = b["sent"] + b["failed"] + b["blocked"] + await count_user_ids_after(b["cursor"])
+    sem    = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    saving = asyncio.Lock()
+    blocked_ids: list[int] = []  # заблокировавшие бота, ещё не записанные в БД
+
+    async def progress():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await edit_broadcast_status(bot, b, total)
+
+    async def checkpoint():
+        # Снимок берём до await: счётчики, курсор и blocked_ids должны совпадать
+        snapshot, ids = dict(b), blocked_ids[:]
+        blocked_ids.clear()
+        async with saving:
+            await save_broadcast_progress(snapshot, ids)
+
+    async def send_page(user_ids: list[int]):
+        results: dict[int, str] = {}  # позиция на странице -> результат, ещё не вошедший в курсор
+        head = 0
+
+        async def send(i: int, user_id: int):
+            nonlocal head
+            async with sem:
+                results[i] = await broadcast_send(bot, user_id, text)
+            while head in results:
+                result = results.pop(head)
+                b[result] += 1
+                if result == "blocked":
+                    blocked_ids.append(user_ids[head])
+                    known_users.pop(user_ids[head], None)  # напишет снова — upsert снимет blocked
+                b["cursor"] = user_ids[head]
+                head += 1
+            if not saving.locked():  # запись уже идёт — следующую сделает кто-то из соседей или конец страницы
+                await checkpoint()
+
+        async with asyncio.TaskGroup() as group:
+            for i, user_id in enumerate(user_ids):
+                group.create_task(send(i, user_id))
+
+    progress_task = asyncio.create_task(progress())
+    try:
+        while user_ids := await get_user_ids_after(b["cursor"], BROADCAST_PAGE_SIZE):
+            await send_page(user_ids)
+            await checkpoint()
+        b["status"] = "done"
+        await checkpoint()
+    finally:
+        progress_task.cancel()
+    await edit_broadcast_status(bot, b, total)
+
+
+def start_broadcast(bot, b: dict):
+    async def runner():
+        try:
+            await run_broadcast(bot, b)
+        except Exception as error:
+            log.exception(f"Ошибка рассылки #{b['id']}: {error}")
+
+    task = asyncio.create_task(runner())
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+
+
+async def resume_broadcasts(bot):
+    for b in await get_running_broadcasts():
+        if b["admin_chat_id"] % REPLICA_COUNT != REPLICA_ID:
+            continue  # рассылку ведёт реплика, которой принадлежит чат админа
+        log.info(f"▶️ Продолжаю рассылку #{b['id']} с user_id > {b['cursor']}")
+        start_broadcast(bot, b)
 
 
 # ──────────────────────────────────────────
@@ -261,7 +2968,12 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ Нет доступа")
         return
 
-    stats = await get_stats()
+    stats = {}
+    if db_available():
+        try:
+            stats = await get_stats()
+        except DB_DOWN_ERRORS as error:
+            db_failed(error)
     top = "\n".join([f"  {r['first_name']}: {r['questions']} вопр." for r in stats.get("top_users", [])])
 
     await update.message.reply_text(
@@ -269,7 +2981,22 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"👥 Пользователей: {stats.get('total_users', 0)}\n"
         f"❓ Всего вопросов: {stats.get('total_questions', 0)}\n"
         f"⭐ Средняя оценка: {stats.get('avg_rating', 0)}\n\n"
-        f"🏆 Топ пользователей:\n{top}",
+        f"🏆 Топ пользователей:\n{top}\n\n"
+        f"🤖 Mistral: {llm_latency_summary()}\n"
+        f"⏱️ Очередь LLM: {llm_scheduler.stats_text()}\n"
+        f"🗃️ Кэш ответов: {len(answer_cache)} шт., "
+        f"попаданий {answer_cache_stats['hits']}, промахов {answer_cache_stats['misses']}\n"
+        f"📄 Кэш документов: {len(doc_cache)} шт., "
+        f"попаданий {doc_cache_stats['hits']}, промахов {doc_cache_stats['misses']}\n"
+        f"💾 Запись в БД: в очереди {pending_rows()}, батчей {write_stats['flushes']}, "
+        f"строк {write_stats['rows']}, ошибок {write_stats['errors']}, отброшено {write_stats['dropped']}\n"
+        f"🩺 БД: {db_status_text()}\n"
+        f"🧠 История: {history_store.stats_text()}\n"
+        f"🔗 Склеено сообщений: {coalesce_stats['coalesced']}\n"
+        f"🧩 Реплика {REPLICA_ID + 1}/{REPLICA_COUNT}, переслано {replica_stats['forwarded']}, "
+        f"ошибок {replica_stats['forward_errors']}; состояние: {state_store.stats_text()}\n"
+        f"📜 Кодексы: {len(codex_index) if codex_index else 0} статей, "
+        f"прямых ответов {codex_stats['lookups']}, подсказок в промпт {codex_stats['rag']}",
         reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("📢 Рассылка", callback_data="admin_broadcast")]
         ])
@@ -283,26 +3010,71 @@ async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Использование: /broadcast текст сообщения")
         return
 
+    if not DATABASE_URL:
+        await update.message.reply_text("⚠️ Рассылка работает только с БД")
+        return
+    if not db_available():
+        await update.message.reply_text("⚠️ БД сейчас недоступна, рассылку запустить нельзя — попробуй позже")
+        return
+
     text = " ".join(context.args)
-    user_ids = await get_all_user_ids()
-    sent, failed = 0, 0
+    msg  = await update.message.reply_text("📢 Запускаю рассылку...")
+    try:
+        b = await create_broadcast(text, msg.chat_id, msg.message_id)
+    except DB_DOWN_ERRORS as error:
+        db_failed(error)
+        await msg.edit_text("⚠️ БД сейчас недоступна, рассылка не запущена — попробуй позже")
+        return
+    start_broadcast(context.bot, b)
 
-    msg = await update.message.reply_text(f"📢 Отправляю {len(user_ids)} пользователям...")
 
-    for user_id in user_ids:
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile 0.1 — профилировать 10% вызовов, /profile off, /profile reset, /profile — отчёт"""
+    if not is_admin(update.effective_user.id):
+        return
+    arg = context.args[0] if context.args else ""
+    if arg == "off":
+        profile_state["rate"] = 0.0
+        await update.message.reply_text("⏹ Профилирование выключено")
+        return
+    if arg == "reset":
+        profile_state.update(samples=0, stats=None)
+        await update.message.reply_text("🧹 Статистика профайлера сброшена")
+        return
+    if arg:
         try:
-            await context.bot.send_message(user_id, f"📢 Сообщение от Сократа:\n\n{text}")
-            sent += 1
-            await asyncio.sleep(0.05)
-        except Exception:
-            failed += 1
+            profile_state["rate"] = min(1.0, max(0.0, float(arg)))
+        except ValueError:
+            await update.message.reply_text("Использование: /profile [доля 0..1 | off | reset]")
+            return
+        await update.message.reply_text(f"▶️ Профилирую {profile_state['rate']:.0%} вызовов хендлеров")
+        return
 
-    await msg.edit_text(f"✅ Отправлено: {sent}\n❌ Ошибок: {failed}")
+    if profile_state["stats"] is None:
+        await update.message.reply_text(f"Пока нет данных (доля {profile_state['rate']:.0%})")
+        return
+    out = io.StringIO()
+    profile_state["stats"].stream = out
+    profile_state["stats"].sort_stats("cumulative").print_stats(15)
+    await update.message.reply_text(
+        f"🔬 Выборок: {profile_state['samples']}\n\n" + out.getvalue()[-3800:]
+    )
 
 
 # ──────────────────────────────────────────
 # КНОПКИ
 # ──────────────────────────────────────────
+def parse_rating(data: str) -> tuple[int, int] | None:
+    """rate_<оценка>_<question_id> → (оценка, question_id) или None, если данные подделаны"""
+    parts = data.split("_")
+    if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
+        return None
+    rating, question_id = int(parts[1]), int(parts[2])
+    if rating not in (1, 5) or not 0 < question_id <= 2**31 - 1:  # questions.id — int4
+        return None
+    return rating, question_id
+
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -310,9 +3082,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Рейтинг
     if query.data.startswith("rate_"):
-        parts = query.data.split("_")
-        rating      = int(parts[1])
-        question_id = int(parts[2])
+        parsed = parse_rating(query.data)
+        if parsed is None:
+            return  # callback_data присылает клиент — мусор в БД не пускаем
+        rating, question_id = parsed
         await save_rating(question_id, rating)
         emoji = "👍" if rating == 5 else "👎"
         await query.edit_message_reply_markup(reply_markup=None)
@@ -327,7 +3100,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if query.data == "clear":
-        histories[user_id].clear()
+        await history_store.clear(user_id)
         await query.edit_message_text("🗑️ История очищена!", reply_markup=main_keyboard())
 
     elif query.data == "search":
@@ -336,7 +3109,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Напиши что ищешь, например:\n"
             "• УК РФ статья 228\n"
             "• ГК РФ возмещение ущерба\n"
-            "• ТК РФ увольнение",
+            "• ТК РФ увольнение\n\n"
+            "Точный номер статьи — и я сразу пришлю её текст.",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Назад", callback_data="back")]])
         )
 
@@ -356,7 +3130,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"📊 Твоя статистика:\n\n"
             f"❓ Задано вопросов: {s['questions']}\n"
             f"📅 Со мной с: {s['joined_at']}\n"
-            f"💬 Сообщений в памяти: {len(histories[user_id])}",
+            f"💬 Сообщений в памяти: {len(await history_store.get(user_id))}",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Назад", callback_data="back")]])
         )
 
@@ -371,37 +3145,117 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ТЕКСТ
 # ──────────────────────────────────────────
 async def reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """На пользователя — один ответ за раз. Всё, что он пришлёт, пока ответ готовится,
+    склеивается в один следующий вопрос, чтобы не гонять историю наперегонки и не платить за лишние запросы."""
     user    = update.effective_user
     user_id = user.id
-    question = update.message.text
 
     await save_user(user_id, user.username, user.first_name)
 
-    if not rate_limit_check(user_id):
-        await update.message.reply_text("⏳ Не торопись, подожди пару секунд!")
+    if user_id in user_inflight:
+        user_inflight[user_id].append(update.message)
+        coalesce_stats["coalesced"] += 1
         return
 
-    histories[user_id].append({"role": "user", "content": question})
-    if len(histories[user_id]) > MAX_HISTORY:
-        histories[user_id] = histories[user_id][-MAX_HISTORY:]
-
-    await increment_questions(user_id)
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-
+    # Занимаем слот до первого await: проверка лимита в postgres-режиме ходит в базу,
+    # и сообщения пачки, пришедшие за это время, должны склеиться, а не получить отказ
+    user_inflight[user_id] = []
     try:
-        text = await get_ai_response(histories[user_id])
-        histories[user_id].append({"role": "assistant", "content": text})
-
-        question_id = await save_question(user_id, question, text)
-        last_question_id[user_id] = question_id
-
-        await update.message.reply_text(text, reply_markup=rating_keyboard(question_id))
+        if not await rate_limit_check(user_id):
+            RATE_LIMITED.inc()
+            # Один отказ на всю пачку: сообщения, пришедшие во время проверки, отклонены вместе с первым
+            await update.message.reply_text("⏳ Не торопись, подожди пару секунд!")
+            return
 
+        message, question = update.message, update.message.text
+        while True:
+            await answer_question(context, user_id, message, question)
+            queued = user_inflight[user_id]
+            if not queued:
+                break
+            user_inflight[user_id] = []
+            # Склейка пачки не длиннее бюджета контекста — иначе запрос заведомо упадёт
+            message, question = queued[-1], fit_to_budget("\n\n".join(m.text for m in queued))
+    finally:
+        del user_inflight[user_id]
+
+
+async def reply_error(message: Message, msg: Message | None, text: str):
+    """Ошибка после заглушки «💭 ...» или недописанного ответа с курсором правит это сообщение,
+    а не приходит отдельным — иначе заглушка так и висит в чате"""
+    if msg is not None:
+        for _ in range(2):
+            try:
+                await msg.edit_text(text)
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(retry_after_seconds(e))
+            except BadRequest:
+                break
+    await message.reply_text(text)
+
+
+async def answer_question(context: ContextTypes.DEFAULT_TYPE, user_id: int, message: Message, question: str):
+    with stage("db"):
+        first_turn = not await history_store.get(user_id)
+        await history_store.append(user_id, {"role": "user", "content": question})
+        history = await history_store.get(user_id)
+        await increment_questions(user_id)
+
+    msg = None
+    try:
+        usage = {}
+        doc_id, direct = codex_index.lookup(question) if codex_index else (None, False)
+        if direct:
+            codex_stats["lookups"] += 1
+            ready, source = codex_article_reply(doc_id), "codex"  # текст статьи целиком, без Mistral
+        else:
+            ready, source = cache_get(question) if first_turn else None, "cache"
+        if ready:
+            text = ready
+        else:
+            source = "llm"
+            history[-1] = {"role": "user", "content": with_codex_context(question)}
+            with stage("telegram"):
+                await context.bot.send_chat_action(chat_id=message.chat_id, action="typing")
+            with stage("llm"):
+                if STREAM_REPLIES:
+                    with stage("telegram"):
+                        msg = await message.reply_text("💭 ...")
+                    text = await stream_to_message(msg, history, usage=usage, user_id=user_id)
+                else:
+                    text = await get_ai_response(history, usage, user_id)
+        ANSWERS.inc(source=source)
+
+        with stage("db"):
+            await history_store.append(user_id, {"role": "assistant", "content": text})
+            if first_turn and not ready:
+                cache_put(question, text)
+            question_id = await save_question(user_id, question, text, usage)
+
+        with stage("telegram"):
+            if STREAM_REPLIES and not ready:
+                await msg.edit_text(text[:4096], reply_markup=rating_keyboard(question_id))
+            else:
+                await message.reply_text(text, reply_markup=rating_keyboard(question_id))
+
+    except LLMBusy:
+        ERRORS.inc(type="LLMBusy")
+        await reply_error(message, msg, "⏳ Слишком много вопросов разом, попробуй через минуту.")
+    except LLMUnavailable:
+        ERRORS.inc(type="LLMUnavailable")
+        await reply_error(message, msg, "⚠️ Сократ сейчас недоступен, попробуй через минуту.")
     except httpx.HTTPStatusError as e:
-        await update.message.reply_text(f"⚠️ Ошибка {e.response.status_code}:\n{e.response.text[:300]}")
+        ERRORS.inc(type=f"mistral_{e.response.status_code}")
+        log.warning(f"Ошибка Mistral {e.response.status_code}: {e.response.text[:300]}")
+        if e.response.status_code == 429:
+            await reply_error(message, msg, "⏳ Слишком много вопросов разом, попробуй через минуту.")
+        else:
+            await reply_error(message, msg, f"⚠️ Ошибка {e.response.status_code}, попробуй позже.")
     except Exception as error:
-        print(f"Ошибка reply: {error}")
-        await update.message.reply_text("⚠️ Что-то пошло не так, попробуй позже.")
+        ERRORS.inc(type=type(error).__name__)
+        log.exception(f"Ошибка reply: {error}")
+        await reply_error(message, msg, "⚠️ Что-то пошло не так, попробуй позже.")
 
 
 # ──────────────────────────────────────────
@@ -409,35 +3263,51 @@ async def reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ──────────────────────────────────────────
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = await update.message.reply_text("📄 Читаю документ...")
+    progress = DocProgress(msg)
 
     try:
-        doc      = update.message.document
-        doc_file = await doc.get_file()
-        doc_path = f"/tmp/doc_{update.effective_user.id}_{doc.file_name}"
-        await doc_file.download_to_drive(doc_path)
-
-        doc_text = read_document_text(doc_path, doc.file_name)
-        os.remove(doc_path)
-
-        if not doc_text.strip():
-            await msg.edit_text("⚠️ Не смог прочитать текст из документа.")
+        doc = update.message.document
+        if doc.file_size and doc.file_size > DOC_MAX_BYTES:
+            await msg.edit_text(f"⚠️ Файл больше {DOC_MAX_BYTES // (1024 * 1024)} МБ, не осилю.")
             return
-
-        await msg.edit_text("🔍 Анализирую...")
-
-        result = await get_ai_response([{
-            "role": "user",
-            "content": (
-                f"Проанализируй этот документ как юрист:\n\n{doc_text}\n\n"
-                "Найди: 1) Риски 2) Незаконные пункты 3) Рекомендации. Кратко, на русском."
-            )
-        }])
-
-        await msg.edit_text(f"📋 Анализ:\n\n{result}")
-
+        with stage("telegram"):
+            doc_file = await doc.get_file()
+            data     = bytes(await doc_file.download_as_bytearray())
+
+        digest = hashlib.sha256(data).hexdigest()
+        report = doc_cache_get(digest)
+        if report is None and digest in doc_inflight:
+            await progress.update("⏳ Такой же документ уже разбирается, жду результат...", force=True)
+            report = await asyncio.shield(doc_inflight[digest])
+            if report is None:
+                await msg.edit_text("⚠️ Не получилось разобрать документ, попробуй ещё раз.")
+                return
+        elif report is None:
+            report = await analyze_upload(data, doc.file_name or "", digest, progress, update.effective_user.id)
+            if report is None:
+                await msg.edit_text("⚠️ Не смог прочитать текст из документа.")
+                return
+
+        with stage("telegram"):
+            await msg.edit_text(f"📋 Анализ:\n\n{report}"[:4096])
+
+    except asyncio.TimeoutError:
+        ERRORS.inc(type="DocumentTimeout")
+        await reply_error(update.message, msg, "⚠️ Документ слишком тяжёлый, не успел его прочитать.")
+    except BrokenProcessPool:
+        ERRORS.inc(type="BrokenProcessPool")
+        await reply_error(update.message, msg, "⚠️ Не получилось прочитать документ, пришли его ещё раз.")
+    except LLMBusy:
+        ERRORS.inc(type="LLMBusy")
+        await reply_error(update.message, msg, "⏳ Сейчас много документов в работе, пришли этот через пару минут.")
+    except LLMUnavailable:
+        ERRORS.inc(type="LLMUnavailable")
+        await reply_error(update.message, msg, "⚠️ Сократ сейчас недоступен, попробуй через минуту.")
     except Exception as error:
-        print(f"Ошибка документа: {error}")
-        await msg.edit_text(f"⚠️ Ошибка: {error}")
+        ERRORS.inc(type=type(error).__name__)
+        log.exception(f"Ошибка документа: {error}")
+        # Финальный отчёт мог упасть посреди стрима — недописанный текст с курсором заменяем
+        await reply_error(update.message, msg, f"⚠️ Ошибка: {error}"[:4096])
 
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -448,28 +3318,238 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("📸 Отправь документ в PDF или TXT для анализа.")
 
 
+# ──────────────────────────────────────────
+# WEBHOOK
+# ──────────────────────────────────────────
+webhook_state = {"draining": False, "accepted": 0, "rejected": 0}
+MetricCallback("bot_update_queue_size", "Принятые webhook-апдейты, ещё не обработанные", "gauge",
+               lambda: len(admitted_updates))
+
+# Принятые, но ещё не обработанные апдейты. Очередь PTB тут не помогает: при concurrent_updates
+# он сразу забирает из неё каждый апдейт в отдельную задачу, и та ждёт семафор уже в памяти.
+admitted_updates: set[int] = set()
+ADMISSION_LIMIT = UPDATE_QUEUE_SIZE + CONCURRENT_UPDATES
+
+
+class AdmissionUpdateProcessor(SimpleUpdateProcessor):
+    """Апдейт покидает admitted_updates, только когда PTB его обработал"""
+    __slots__ = ()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        try:
+            await coroutine
+        finally:
+            if isinstance(update, Update):
+                admitted_updates.discard(update.update_id)
+
+
+def make_webhook_app(application):
+    """aiohttp-приложение: проверяет секрет и отдаёт апдейт PTB, пока принятых и необработанных
+    меньше ADMISSION_LIMIT. Лимит исчерпан или идёт остановка — 503, Telegram повторит доставку позже."""
+    from aiohttp import web
+
+    async def telegram_webhook(request: web.Request) -> web.Response:
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # Байты, а не str: compare_digest падает с TypeError на не-ASCII строках
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            return web.Response(status=403)
+        if webhook_state["draining"]:
+            return web.Response(status=503, headers={"Retry-After": "5"})
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+        try:
+            update = Update.de_json(data, application.bot)
+        except (KeyError, TypeError, ValueError):
+            return web.Response(status=400)
+        owner = update_owner(update)
+        if owner != REPLICA_ID and "X-Sokrat-Forwarded-By" not in request.headers:
+            status = await forward_update(data, owner)
+            if status == 200:
+                return web.Response()
+            if status is not None:
+                # Владелец жив, но перегружен — пусть Telegram повторит позже
+                return web.Response(status=503, headers={"Retry-After": "1"})
+            # Владелец лежит — лучше ответить самим, чем потерять сообщение
+        if update.update_id in admitted_updates:
+            return web.Response()  # повтор доставки, а мы его ещё обрабатываем
+        if len(admitted_updates) >= ADMISSION_LIMIT:
+            webhook_state["rejected"] += 1
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        admitted_updates.add(update.update_id)
+        application.update_queue.put_nowait(update)
+        webhook_state["accepted"] += 1
+        return web.Response()
+
+    async def healthz(request: web.Request) -> web.Response:
+        status = 503 if webhook_state["draining"] else 200
+        return web.json_response({
+            "queue": len(admitted_updates),
+            "draining": webhook_state["draining"],
+            "accepted": webhook_state["accepted"],
+            "rejected": webhook_state["rejected"],
+        }, status=status)
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    app.router.add_get("/healthz", healthz)
+    return app
+
+
+async def run_webhook(application):
+    """Жизненный цикл как у run_polling, но апдейты приходят по HTTP.
+    По SIGTERM перестаём принимать апдейты и дорабатываем очередь до конца."""
+    from aiohttp import web
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # Как в run_polling: упал старт (занят порт, ошибка в post_init) — всё равно закрываем то, что успели поднять
+    runner = None
+    try:
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+
+        runner = web.AppRunner(make_webhook_app(application))
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", WEBHOOK_PORT).start()
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        log.info(f"✅ Webhook слушает :{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+        await stop.wait()
+    finally:
+        webhook_state["draining"] = True
+        if application.running:
+            log.info(f"⏳ Останавливаюсь, в обработке {len(admitted_updates)} апдейтов")
+            await application.stop()  # дожидается обработки всей очереди
+        if runner:
+            await runner.cleanup()
+        await application.shutdown()  # без initialize — ничего не делает
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
 # ──────────────────────────────────────────
 # ЗАПУСК
 # ──────────────────────────────────────────
+async def startup_step(name: str, coro):
+    started = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        startup_timings.append((name, time.perf_counter() - started))
+
+
+def log_startup():
+    total = time.perf_counter() - BOOT_STARTED
+    if STARTUP_PROFILE:
+        for name, seconds in startup_timings:
+            log.info(f"⏱️ {name}: {seconds * 1000:.0f} мс")
+    log.info(f"🚀 Готов к работе за {total * 1000:.0f} мс с импорта", extra={"fields": {
+        "startup_ms": {name: round(seconds * 1000) for name, seconds in startup_timings},
+    }})
+
+
+MetricCallback("bot_startup_seconds", "Время шагов старта", "gauge",
+               lambda: {(("step", name),): round(seconds, 4) for name, seconds in startup_timings})
+
+prewarm_task: asyncio.Task | None = None
+
+
+async def on_db_connected(bot):
+    """То, что на старте пропустили без БД"""
+    await warm_answer_cache()
+    await resume_broadcasts(bot)
+
+
 async def post_init(application):
-    await init_db()
+    global history_store, state_store, prewarm_task
+    startup_timings.append(("build + initialize", time.perf_counter() - IMPORTS_DONE))  # Application, getMe, aiohttp для webhook
+    # Независимые шаги — параллельно: пул БД с миграциями, индекс кодексов и соединение с Mistral
+    await asyncio.gather(
+        startup_step("db", init_db()),
+        startup_step("codex", asyncio.to_thread(load_codex_index)),
+        startup_step("http", init_http()),
+    )
+    history_store = make_history_store()
+    state_store = make_state_store()
+    state_store.start()
+    if db_pool:
+        await startup_step("answer cache", warm_answer_cache())
+    start_write_behind()
+    start_db_health(lambda: on_db_connected(application.bot))
+    if db_pool:
+        await startup_step("broadcasts", resume_broadcasts(application.bot))
+    await startup_step("metrics", start_metrics_server(application))
+    if DOC_PREWARM:
+        prewarm_task = asyncio.create_task(prewarm_documents())
+    log_startup()
+
+
+async def post_shutdown(application):
+    if prewarm_task:
+        prewarm_task.cancel()
+    await stop_metrics_server()
+    await state_store.stop()
+    await close_replica_client()
+    await stop_db_health()
+    await stop_write_behind()
+    await close_http()
+    reset_doc_pool()
+
+
+def build_application():
+    bot = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .concurrent_updates(AdmissionUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    bot.add_handler(CommandHandler("start",     instrumented("start",     start)))
+    bot.add_handler(CommandHandler("help",      instrumented("help",      help_cmd)))
+    bot.add_handler(CommandHandler("admin",     instrumented("admin",     admin_cmd)))
+    bot.add_handler(CommandHandler("broadcast", instrumented("broadcast", broadcast_cmd)))
+    bot.add_handler(CommandHandler("profile",   instrumented("profile",   profile_cmd)))
+    bot.add_handler(CallbackQueryHandler(instrumented("button", button_handler)))
+    bot.add_handler(MessageHandler(filters.VOICE,        instrumented("voice",    handle_voice)))
+    # Ответы и документы ждут Mistral вне слотов PTB (block=False): иначе под нагрузкой
+    # семафор CONCURRENT_UPDATES становится настоящей очередью, и кнопки с командами стоят за LLM.
+    # Их приём ограничивает очередь llm_scheduler (LLM_QUEUE_MAX).
+    bot.add_handler(MessageHandler(filters.Document.ALL, instrumented("document", handle_document), block=False))
+    bot.add_handler(MessageHandler(filters.PHOTO,        instrumented("photo",    handle_photo)))
+    bot.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented("reply", reply), block=False))
+    if REPLICA_COUNT > 1 and BOT_MODE == "polling":
+        bot.add_handler(TypeHandler(Update, route_update), group=-1)
+    bot.add_error_handler(on_error)
+    return bot
 
 
 def main():
-    bot = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(post_init).build()
-
-    bot.add_handler(CommandHandler("start",     start))
-    bot.add_handler(CommandHandler("help",      help_cmd))
-    bot.add_handler(CommandHandler("admin",     admin_cmd))
-    bot.add_handler(CommandHandler("broadcast", broadcast_cmd))
-    bot.add_handler(CallbackQueryHandler(button_handler))
-    bot.add_handler(MessageHandler(filters.VOICE,        handle_voice))
-    bot.add_handler(MessageHandler(filters.Document.ALL, handle_document))
-    bot.add_handler(MessageHandler(filters.PHOTO,        handle_photo))
-    bot.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, reply))
-
-    print("✅ Сократ запущен с БД и админкой!")
-    bot.run_polling(drop_pending_updates=True)
+    setup_logging()
+    bot = build_application()
+    log.info(f"✅ Сократ запущен с БД и админкой! Режим: {BOT_MODE}")
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(bot))
+    else:
+        bot.run_polling(drop_pending_updates=DROP_PENDING_UPDATES)
 
 
 if __name__ == "__main__":